@@ -0,0 +1,142 @@
+import os
+import sys
+import datetime
+import discord
+from dotenv import load_dotenv
+from prisma import Prisma
+
+'''
+    BACKFILL - moves users keyed by username to (guild_id, user_id) snowflakes
+
+    Run once against the old schema, before `prisma db push`:
+        python backfill.py --dry-run    (only reports what would happen)
+        python backfill.py
+        prisma db push                  (adds the new indexes & the Warning relation)
+
+    Usernames are matched against the members of every guild the bot is in, by name & by
+    "name#1234" (how usernames used to be stored). A user found in several guilds gets a row in
+    each of them with the same XP, their coins & warnings stay in the first guild (the copies start
+    with 0 coins). Users & warnings that can't be matched are moved to UserArchive & WarningArchive.
+'''
+
+load_dotenv()  # Load .env file
+
+# Load environment variables
+TOKEN = os.getenv('DISCORD_TOKEN')
+DRY_RUN = '--dry-run' in sys.argv
+
+# Members are needed to match usernames to IDs
+intents = discord.Intents.none()
+intents.guilds = True
+intents.members = True
+client = discord.Client(intents=intents)
+
+
+# Map every username to the (guild_id, user_id) keys it has across the bot's guilds
+# Old rows may hold the name or "name#1234" (str(member)), so both are mapped
+async def fetchMemberKeys():
+    keys = {}
+    for guild in client.guilds:
+        for member in await guild.chunk():
+            for username in {member.name, str(member)}:
+                keys.setdefault(username, []).append((guild.id, member.id))
+    return keys
+
+
+# Move every user & warning to the new keys in one transaction
+async def backfill(prisma, member_keys):
+    users = await prisma.query_raw('SELECT username FROM "User"')
+    matched = {user['username']: member_keys[user['username']] for user in users if user['username'] in member_keys}
+    unmatched = [user['username'] for user in users if user['username'] not in member_keys]
+
+    print(f'Backfill: {len(matched)} users matched, {len(unmatched)} unmatched')
+    for username in unmatched:
+        print(f'Backfill: no member named {username}, their row & warnings will be archived')
+    if DRY_RUN:
+        return
+
+    async with prisma.tx(timeout=datetime.timedelta(minutes=10)) as tx:
+        # Add the new key columns & drop the username key
+        await tx.execute_raw('ALTER TABLE "User" ADD COLUMN guild_id BIGINT, ADD COLUMN user_id BIGINT')
+        await tx.execute_raw('ALTER TABLE "Warning" ADD COLUMN guild_id BIGINT, ADD COLUMN "issuedBy_id" BIGINT')
+        await tx.execute_raw('ALTER TABLE "User" DROP CONSTRAINT "User_pkey" CASCADE')
+        await tx.execute_raw('DROP INDEX IF EXISTS "User_username_key"')
+
+        for username, keys in matched.items():
+            # First guild keeps the existing row
+            guild_id, user_id = keys[0]
+            await tx.execute_raw(
+                'UPDATE "User" SET guild_id = $1, user_id = $2 WHERE username = $3 AND user_id IS NULL',
+                guild_id, user_id, username
+            )
+            await tx.execute_raw(
+                'UPDATE "Warning" SET guild_id = $1, "issuedBy_id" = $2 WHERE "issuedBy_username" = $3',
+                guild_id, user_id, username
+            )
+
+            # Other guilds get a copy of the XP, the coins stay in the first guild
+            for guild_id, user_id in keys[1:]:
+                await tx.execute_raw(
+                    '''
+                    INSERT INTO "User" (guild_id, user_id, username, xp, level, coins, level_rank)
+                    SELECT $1, $2, username, xp, level, 0, level_rank FROM "User"
+                    WHERE username = $3 AND guild_id = $4 AND user_id = $5
+                    ''',
+                    guild_id, user_id, username, keys[0][0], keys[0][1]
+                )
+
+        # Keep unmatched users & warnings in the archive tables (as in schema.prisma) instead of losing them
+        await tx.execute_raw(
+            '''
+            CREATE TABLE IF NOT EXISTS "UserArchive" (
+                username TEXT PRIMARY KEY, xp INTEGER NOT NULL, level INTEGER NOT NULL, coins INTEGER NOT NULL,
+                level_rank INTEGER NOT NULL, archived_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            '''
+        )
+        await tx.execute_raw(
+            '''
+            CREATE TABLE IF NOT EXISTS "WarningArchive" (
+                id INTEGER PRIMARY KEY, reason TEXT NOT NULL, "issuedBy_username" TEXT NOT NULL,
+                archived_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            '''
+        )
+        archived_warnings = await tx.execute_raw(
+            '''
+            INSERT INTO "WarningArchive" (id, reason, "issuedBy_username")
+            SELECT id, reason, "issuedBy_username" FROM "Warning" WHERE "issuedBy_id" IS NULL
+            '''
+        )
+        archived_users = await tx.execute_raw(
+            '''
+            INSERT INTO "UserArchive" (username, xp, level, coins, level_rank)
+            SELECT username, xp, level, coins, level_rank FROM "User" WHERE user_id IS NULL
+            '''
+        )
+        await tx.execute_raw('DELETE FROM "Warning" WHERE "issuedBy_id" IS NULL')
+        await tx.execute_raw('DELETE FROM "User" WHERE user_id IS NULL')
+
+        # Key users by their snowflakes
+        await tx.execute_raw('ALTER TABLE "User" ALTER COLUMN guild_id SET NOT NULL, ALTER COLUMN user_id SET NOT NULL')
+        await tx.execute_raw('ALTER TABLE "User" ADD CONSTRAINT "User_pkey" PRIMARY KEY (guild_id, user_id)')
+        await tx.execute_raw(
+            'ALTER TABLE "Warning" ALTER COLUMN guild_id SET NOT NULL, ALTER COLUMN "issuedBy_id" SET NOT NULL'
+        )
+
+    print(f'Backfill: done, archived {archived_users} unmatched users & {archived_warnings} warnings. '
+          'Run `prisma db push` to add the new indexes.')
+
+
+@client.event
+async def on_ready():
+    prisma = Prisma()
+    await prisma.connect()
+    try:
+        await backfill(prisma, await fetchMemberKeys())
+    finally:
+        await prisma.disconnect()
+        await client.close()
+
+
+client.run(TOKEN)
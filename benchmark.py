@@ -0,0 +1,493 @@
+import io
+import sys
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+from types import SimpleNamespace
+
+import main
+
+'''
+    BENCHMARK - drives the message & command paths offline, no Discord or database needed
+
+        python benchmark.py                                   (every scenario with the defaults)
+        python benchmark.py --scenario messages --messages 50000 --rate 5000
+        python benchmark.py --users 2000 --channels 50 --db-latency-ms 2
+
+    Handlers run unchanged against fake guilds, channels & members, and a stand-in for the
+    database that keeps users, channels & the coin ledger in memory. Every awaited Prisma call
+    (or batch) is one round trip and waits --db-latency-ms, like a query to a nearby database.
+    The stand-in applies every statement atomically, so the bets scenario only checks the
+    handlers' bookkeeping (settled bets reach the ledger), not Postgres row locking. The
+    concurrency guarantee itself is tested against a real Postgres in
+    tests/test_settle_bet_postgres.py.
+
+    Reports throughput, p50/p99 handler latency & DB round trips per operation.
+'''
+
+SCENARIOS = ['messages', 'awardxp', 'leaderboard', 'games', 'bets']
+
+
+'''
+    FAKE DATABASE
+'''
+
+
+# Same as main.levelSql
+def levelFor(level, xp):
+    return max(level, main.levelForXp(xp))
+
+
+# Check a row against a Prisma where clause (only the filters the bot uses)
+def matches(row, where):
+    for field, condition in where.items():
+        if field == 'OR':
+            if not any(matches(row, option) for option in condition):
+                return False
+        elif field == 'guild_id_user_id':
+            if (row['guild_id'], row['user_id']) != (condition['guild_id'], condition['user_id']):
+                return False
+        elif isinstance(condition, dict):
+            value = row[field]
+            if 'gt' in condition and not value > condition['gt']:
+                return False
+            if 'lt' in condition and not value < condition['lt']:
+                return False
+            if 'in' in condition and value not in condition['in']:
+                return False
+        elif row[field] != condition:
+            return False
+    return True
+
+
+# Apply a Prisma update (plain values, increment & decrement) to a row
+def applyUpdate(row, data):
+    for field, value in data.items():
+        if isinstance(value, dict):
+            row[field] += value.get('increment', 0) - value.get('decrement', 0)
+        else:
+            row[field] = value
+
+
+# One table of the stand-in, rows are dicts & model results are returned as objects like Prisma's
+class FakeTable:
+    def __init__(self, database, defaults):
+        self.database = database
+        self.defaults = defaults
+        self.rows = []
+
+    def insert(self, data):
+        row = {**self.defaults, **data}
+        self.rows.append(row)
+        return row
+
+    def select(self, where):
+        return [row for row in self.rows if matches(row, where or {})]
+
+    async def create(self, data):
+        await self.database.roundTrip()
+        return SimpleNamespace(**self.insert(data))
+
+    async def create_many(self, data):
+        await self.database.roundTrip()
+        for row in data:
+            self.insert(row)
+        return len(data)
+
+    async def find_unique(self, where, include=None):
+        await self.database.roundTrip()
+        rows = self.select(where)
+        return SimpleNamespace(**rows[0]) if rows else None
+
+    async def find_many(self, where=None, take=None, order=None, include=None):
+        await self.database.roundTrip()
+        rows = self.select(where)
+        for sort in reversed(order or []):
+            (field, direction), = sort.items()
+            rows.sort(key=lambda row: row[field], reverse=direction == 'desc')
+        return [SimpleNamespace(**row) for row in rows[:take]]
+
+    async def count(self, where=None):
+        await self.database.roundTrip()
+        return len(self.select(where))
+
+    async def update(self, where, data):
+        await self.database.roundTrip()
+        rows = self.select(where)
+        if not rows:
+            return None
+        self.database.write(rows[0], data)
+        return SimpleNamespace(**rows[0])
+
+    async def update_many(self, where, data):
+        await self.database.roundTrip()
+        return self.updateMany(where, data)
+
+    def updateMany(self, where, data):
+        rows = self.select(where)
+        for row in rows:
+            self.database.write(row, data)
+        return len(rows)
+
+    async def upsert(self, where, data):
+        await self.database.roundTrip()
+        rows = self.select(where)
+        if rows:
+            applyUpdate(rows[0], data['update'])
+            return SimpleNamespace(**rows[0])
+        return SimpleNamespace(**self.insert(data['create']))
+
+
+# Operations queued on a batch, run together as one round trip when the batch exits
+class FakeBatch:
+    def __init__(self, database):
+        self.database = database
+        self.operations = []
+
+    def __getattr__(self, table):
+        batch = self
+
+        class Recorder:
+            def __getattr__(self, action):
+                return lambda **kwargs: batch.operations.append((table, action, kwargs))
+
+        return Recorder()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is not None or not self.operations:
+            return
+        await self.database.roundTrip()
+        for table, action, kwargs in self.operations:
+            if action != 'update_many':
+                raise NotImplementedError(f'benchmark has no stand-in for batched {table}.{action}')
+            getattr(self.database, table).updateMany(**kwargs)
+
+
+# Stand-in for the Prisma client, counting round trips
+class FakePrisma:
+    def __init__(self, latency):
+        self.latency = latency
+        self.round_trips = 0
+        self.min_coins = None  # Lowest balance ever written (the bets scenario checks it never goes negative)
+        self.user = FakeTable(self, {'xp': 0, 'level': 0, 'coins': 0, 'level_rank': 0})
+        self.channel = FakeTable(self, {'guild_id': None, 'messages': 0})
+        self.cointransaction = FakeTable(self, {})
+
+    async def roundTrip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def write(self, row, data):
+        applyUpdate(row, data)
+        if 'coins' in row:
+            self.min_coins = row['coins'] if self.min_coins is None else min(self.min_coins, row['coins'])
+
+    def is_connected(self):
+        return True
+
+    def batch_(self):
+        return FakeBatch(self)
+
+    # The raw statements of the hot path, recognised by their shape
+    async def query_raw(self, query, *params):
+        await self.roundTrip()
+        if 'WITH award' in query:
+            awards = [params[i:i + 3] for i in range(0, len(params), 3)]
+            return [row for row in (self.award(*award) for award in awards) if row is not None]
+        if 'u.coins >= $3' in query:
+            row = self.settle(*params)
+            return [row] if row is not None else []
+        if 'SET coins = coins + $3' in query:
+            row = self.changeCoins(*params)
+            return [row] if row is not None else []
+        raise NotImplementedError(f'benchmark has no stand-in for this query: {query.split()[:6]}')
+
+    def award(self, guild_id, user_id, xp, bet=None, winnings=0):
+        rows = self.user.select({'guild_id': guild_id, 'user_id': user_id})
+        if not rows or (bet is not None and rows[0]['coins'] < bet):
+            return None
+        row = rows[0]
+        old_level = row['level']
+        self.write(row, {'coins': {'increment': winnings}, 'xp': {'increment': xp}})
+        row['level'] = levelFor(row['level'], row['xp'])
+        return {**row, 'old_level': old_level}
+
+    # Balance change & ledger entry in one statement, like main.settleBet
+    def settle(self, guild_id, user_id, bet, winnings, xp, reason):
+        row = self.award(guild_id, user_id, xp, bet, winnings)
+        if row is not None:
+            self.cointransaction.insert({'guild_id': guild_id, 'user_id': user_id, 'amount': winnings, 'reason': reason})
+        return row
+
+    # Like main.changeCoins
+    def changeCoins(self, guild_id, user_id, amount, reason):
+        row = self.award(guild_id, user_id, 0, winnings=amount)
+        if row is not None:
+            self.cointransaction.insert({'guild_id': guild_id, 'user_id': user_id, 'amount': amount, 'reason': reason})
+        return row
+
+
+'''
+    FAKE DISCORD
+'''
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.name = f'channel-{channel_id % 1000}'
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeMember:
+    def __init__(self, user_id, guild):
+        self.id = user_id
+        self.name = f'user-{user_id % 100000}'
+        self.mention = f'<@{user_id}>'
+        self.guild = guild
+        self.bot = False
+        self.roles = []
+
+
+class FakeMessage:
+    def __init__(self, message_id, author, channel, content=''):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+
+    async def delete(self):
+        pass
+
+
+# Command context, replies are only counted
+class FakeContext:
+    def __init__(self, message):
+        self.message = message
+        self.author = message.author
+        self.guild = message.guild
+        self.channel = message.channel
+        self.replies = 0
+
+    async def reply(self, *args, **kwargs):
+        self.replies += 1
+
+    async def send(self, *args, **kwargs):
+        self.replies += 1
+
+
+# Guilds, channels & members, with a user row & rank index entry for every member
+# except the last --rowless members (members from before the bot joined, who only get a row once they're active)
+def buildWorld(database, options):
+    snowflakes = iter(range(10 ** 17, 10 ** 18))
+    guilds = [SimpleNamespace(id=next(snowflakes), shard_id=0) for _ in range(options.guilds)]
+    channels = [FakeChannel(next(snowflakes), guilds[i % len(guilds)]) for i in range(options.channels)]
+    members = [FakeMember(next(snowflakes), guilds[i % len(guilds)]) for i in range(options.users)]
+
+    for member in members[:len(members) - options.rowless]:
+        xp = random.randint(0, 5000)
+        row = database.user.insert({'guild_id': member.guild.id, 'user_id': member.id, 'username': member.name,
+                                    'xp': xp, 'level': levelFor(0, xp), 'coins': options.coins})
+        main.rankIndex(member.guild.id).set(member.id, row['xp'], row['level'], row['username'])
+
+    return SimpleNamespace(guilds=guilds, channels={channel.id: channel for channel in channels}, members=members,
+                           rowless=members[len(members) - options.rowless:], snowflakes=snowflakes)
+
+
+def randomMessage(world, content=''):
+    member = random.choice(world.members)
+    channel = random.choice([channel for channel in world.channels.values() if channel.guild is member.guild])
+    return FakeMessage(next(world.snowflakes), member, channel, content)
+
+
+'''
+    RUNNER
+'''
+
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, round(q * (len(latencies) - 1)))]
+
+
+# Run the operations at the given rate (0 = as fast as possible), at most `concurrency` at a time
+async def drive(operations, rate, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(operation):
+        async with limit:
+            started = time.perf_counter()
+            await operation()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, operation in enumerate(operations):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed(operation)))
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started, sorted(latencies)
+
+
+def report(name, count, elapsed, latencies, round_trips):
+    print(f'{name:<12} {count:>7} ops in {elapsed:6.2f}s | {count / elapsed:9.0f} ops/s | '
+          f'p50 {percentile(latencies, 0.5):7.2f}ms | p99 {percentile(latencies, 0.99):7.2f}ms | '
+          f'{round_trips / count:.3f} DB round trips/op')
+
+
+# Message stream through on_message, including the write-behind flushes it causes
+# Rowless members that send a message must end up with a row & their XP
+async def benchMessages(database, world, options):
+    messages = [randomMessage(world) for _ in range(options.messages)]
+    operations = [lambda message=message: main.on_message(message) for message in messages]
+    suppressed = main.xp_suppressed.values.get((), 0)
+    main.startCounterFlusher()
+    elapsed, latencies = await drive(operations, options.rate, options.concurrency)
+    await main.stopCounterFlusher()  # The last flush is part of the cost
+    print(f'messages     {main.xp_suppressed.values.get((), 0) - suppressed} of {len(operations)} XP awards '
+          f'suppressed by the {main.XP_COOLDOWN:g}s cooldown')
+
+    active = {message.author.id: message.author for message in messages}
+    missing = [member for member in world.rowless if member.id in active and not any(
+        row['xp'] > 0 for row in database.user.select({'guild_id': member.guild.id, 'user_id': member.id}))]
+    if missing:
+        print(f'messages     FAIL: {len(missing)} members without a row got no XP')
+        options.failed = True
+    return len(operations), elapsed, latencies
+
+
+async def benchAwardXp(database, world, options):
+    operations = []
+    for _ in range(options.commands):
+        message = randomMessage(world)
+        operations.append(lambda message=message: main.awardXp(message.author, random.randint(1, 50), message.channel.id))
+    elapsed, latencies = await drive(operations, options.rate, options.concurrency)
+    return len(operations), elapsed, latencies
+
+
+async def benchLeaderboard(database, world, options):
+    operations = []
+    for _ in range(options.commands):
+        ctx = FakeContext(randomMessage(world, '?leaderboard'))
+        pages = max(1, len(main.rankIndex(ctx.guild.id)) // main.LEADERBOARD_PAGE_SIZE)
+        operations.append(lambda ctx=ctx, page=random.randint(1, pages): main.leaderboard(ctx, 'page', str(page)))
+    elapsed, latencies = await drive(operations, options.rate, options.concurrency)
+    return len(operations), elapsed, latencies
+
+
+async def benchGames(database, world, options):
+    games = [
+        lambda ctx: main.roll(ctx, str(random.randint(1, 20)), str(random.randint(1, 6))),
+        lambda ctx: main.roulette(ctx, str(random.randint(1, 20))),
+        lambda ctx: main.coinflip(ctx, str(random.randint(1, 20))),
+    ]
+    operations = []
+    for _ in range(options.commands):
+        ctx = FakeContext(randomMessage(world))
+        operations.append(lambda ctx=ctx, game=random.choice(games): game(ctx))
+    elapsed, latencies = await drive(operations, options.rate, options.concurrency)
+    return len(operations), elapsed, latencies
+
+
+# Many bets by one user at once: every settled bet must reach the ledger (row locking is tested against Postgres)
+async def benchBets(database, world, options):
+    member = world.members[0]
+    row = database.user.select({'guild_id': member.guild.id, 'user_id': member.id})[0]
+    row['coins'] = start_coins = 100
+    ledger_before = sum(entry['amount'] for entry in database.cointransaction.select({'user_id': member.id}))
+    database.min_coins = None
+
+    channel_id = next(iter(world.channels))
+    operations = []
+    for _ in range(options.commands):
+        bet = random.randint(1, 30)
+        winnings = bet if random.random() < 0.3 else -bet
+        operations.append(lambda bet=bet, winnings=winnings: main.settleBet(member, bet, winnings, 10, channel_id, 'benchmark'))
+
+    # Every bet in flight at once
+    elapsed, latencies = await drive(operations, 0, len(operations))
+
+    ledger = sum(entry['amount'] for entry in database.cointransaction.select({'user_id': member.id})) - ledger_before
+    if (database.min_coins is not None and database.min_coins < 0) or row['coins'] != start_coins + ledger:
+        print(f'bets         FAIL: lowest balance {database.min_coins}, balance {row["coins"]}, '
+              f'ledger says {start_coins + ledger}')
+        options.failed = True
+    else:
+        print(f'bets         OK: lowest balance {database.min_coins}, balance {row["coins"]} matches the ledger')
+    return len(operations), elapsed, latencies
+
+
+BENCHMARKS = {
+    'messages': benchMessages,
+    'awardxp': benchAwardXp,
+    'leaderboard': benchLeaderboard,
+    'games': benchGames,
+    'bets': benchBets,
+}
+
+
+async def run(options):
+    database = FakePrisma(options.db_latency_ms / 1000)
+    main.prisma = database
+    main.XP_COOLDOWN = options.xp_cooldown
+    world = buildWorld(database, options)
+    main.bot.get_channel = world.channels.get  # Level up announcements
+
+    async def processCommands(message):
+        pass  # Commands are benchmarked on their own
+    main.bot.process_commands = processCommands
+
+    print(f'{options.users} users, {options.guilds} guilds, {options.channels} channels, '
+          f'DB latency {options.db_latency_ms}ms, concurrency {options.concurrency}, '
+          f'rate {options.rate or "unlimited"}/s')
+    for name in options.scenario or SCENARIOS:
+        database.round_trips = 0
+        with contextlib.redirect_stdout(io.StringIO()) as output:  # Keep the handlers' logging out of the report
+            count, elapsed, latencies = await BENCHMARKS[name](database, world, options)
+        for line in output.getvalue().splitlines():
+            if line.startswith(name):
+                print(line)
+        report(name, count, elapsed, latencies, database.round_trips)
+
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the message & command paths')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='run only this scenario (repeatable)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=25)
+    parser.add_argument('--coins', type=int, default=1000, help='starting balance of every user')
+    parser.add_argument('--rowless', type=int, default=50, help='members without a user row when the benchmark starts')
+    parser.add_argument('--messages', type=int, default=20000, help='messages in the message stream')
+    parser.add_argument('--commands', type=int, default=2000, help='invocations per command scenario')
+    parser.add_argument('--rate', type=float, default=0, help='operations started per second (0 = unlimited)')
+    parser.add_argument('--concurrency', type=int, default=100, help='operations in flight at once')
+    parser.add_argument('--db-latency-ms', type=float, default=1, help='latency of every database round trip')
+    parser.add_argument('--xp-cooldown', type=float, default=main.XP_COOLDOWN, help='message XP cooldown in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    options.channels = max(options.channels, options.guilds)  # Every guild needs a channel
+    options.rowless = min(options.rowless, options.users - 1)  # The bets scenario bets as the first member
+    options.failed = False
+    return options
+
+
+if __name__ == '__main__':
+    options = parseOptions()
+    random.seed(options.seed)
+    asyncio.run(run(options))
+    sys.exit(1 if options.failed else 0)
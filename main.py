@@ -1,53 +1,1235 @@
+import time
+startup_started = time.perf_counter()  # Start of the import phase (startup timing report)
+
 import os
 import random
+import asyncio
 import discord
+import hashlib
 import datetime
-import requests
-import matplotlib.pyplot as plt
+import functools
+import contextvars
+from datetime import timezone
+from types import SimpleNamespace
+from collections import OrderedDict
+import aiohttp
+from aiohttp import web
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
+from bisect import bisect_left, bisect_right, insort
 from discord.ext import commands
 from dotenv import load_dotenv
 from prisma import Prisma
 
 load_dotenv()  # Load .env file
+startup_marks = {'started': startup_started, 'imported': time.perf_counter()}  # Phase -> perf_counter
 
 # Load environment variables
 TOKEN = os.getenv('DISCORD_TOKEN')
 NEWS_API = os.getenv('NEWS_API_KEY')
 WEATHER_API = os.getenv('WEATHER_API_KEY')
 
+# Database settings
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_SIZE = os.getenv('DB_POOL_SIZE')  # Prisma connection_limit (unset = Prisma's default)
+DB_POOL_TIMEOUT = os.getenv('DB_POOL_TIMEOUT')  # Seconds a query waits for a pooled connection (unset = Prisma's default)
+DB_HEALTH_INTERVAL = float(os.getenv('DB_HEALTH_INTERVAL', 30))  # Seconds between health checks
+DB_HEALTH_TIMEOUT = float(os.getenv('DB_HEALTH_TIMEOUT', 5))  # Seconds before a health check counts as failed
+DB_RECONNECT_MAX_DELAY = float(os.getenv('DB_RECONNECT_MAX_DELAY', 60))  # Cap on the reconnect backoff
+
+# HTTP client settings
+NEWS_API_URL = os.getenv('NEWS_API_URL', 'https://newsapi.org/v2/top-headlines')
+WEATHER_API_URL = os.getenv('WEATHER_API_URL', 'http://api.weatherapi.com/v1/current.json')
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))  # Seconds before an API request is given up on
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20))  # Keep-alive connections in the pool
+HTTP_MAX_CONCURRENCY = int(os.getenv('HTTP_MAX_CONCURRENCY', 10))  # API requests in flight at once
+
+# Rank index settings
+RANK_PERSIST_INTERVAL = float(os.getenv('RANK_PERSIST_INTERVAL', 300))  # Seconds between level_rank writes
+RANK_PERSIST_BATCH = int(os.getenv('RANK_PERSIST_BATCH', 500))  # level_rank updates per transaction
+
+# Leaderboard settings
+LEADERBOARD_PAGE_SIZE = int(os.getenv('LEADERBOARD_PAGE_SIZE', 10))  # Users per page
+LEADERBOARD_TIMEOUT = float(os.getenv('LEADERBOARD_TIMEOUT', 300))  # Seconds the page buttons stay active
+
+# API response cache settings (seconds / responses)
+NEWS_CACHE_TTL = float(os.getenv('NEWS_CACHE_TTL', 300))  # Headlines are reused for this long
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', 600))  # Weather per location is reused for this long
+API_CACHE_SIZE = int(os.getenv('API_CACHE_SIZE', 256))  # Max responses kept in memory
+API_CACHE_STALE_TTL = float(os.getenv('API_CACHE_STALE_TTL', 3600))  # Expired responses can still be served for this long
+API_CACHE_STALE_WAIT = float(os.getenv('API_CACHE_STALE_WAIT', 2))  # Wait this long for a refresh before serving stale
+
+# Chart rendering settings
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))  # Threads rendering charts off the event loop
+CHART_CACHE_BYTES = int(os.getenv('CHART_CACHE_BYTES', 8 * 1024 * 1024))  # Max total size of cached PNGs
+
+# Sharding settings (unset = let Discord pick the shard count & run every shard in this process)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None  # Total shards across all processes
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None  # Shards this process runs
+
+# Gateway settings
+INTENTS_PROFILE = os.getenv('INTENTS_PROFILE', 'minimal')  # 'minimal' (only what the handlers use) or 'all'
+MEASURE_INTERVAL = float(os.getenv('MEASURE_INTERVAL', 0))  # Seconds between RSS & events/sec reports (0 = off)
+
+# Write-behind counter settings (milliseconds / events)
+COUNTER_FLUSH_INTERVAL_MS = int(os.getenv('COUNTER_FLUSH_INTERVAL_MS', 2000))  # Flush pending counters at least this often
+COUNTER_FLUSH_MAX_EVENTS = int(os.getenv('COUNTER_FLUSH_MAX_EVENTS', 500))  # Flush early once this many events are pending
+COUNTER_MAX_STALENESS_MS = int(os.getenv('COUNTER_MAX_STALENESS_MS', 10000))  # Wake the flusher early once the oldest pending event is older than this
+COUNTER_FLUSH_CHUNK = int(os.getenv('COUNTER_FLUSH_CHUNK', 1000))  # Users per XP statement (3 bind parameters each, Postgres allows 32767)
+
+# XP settings
+XP_COOLDOWN = float(os.getenv('XP_COOLDOWN', 60))  # Seconds before a user can earn message XP again in a guild (0 = every message)
+MAX_LEVEL = int(os.getenv('MAX_LEVEL', 200))  # Highest level on the level curve
+LEVEL_RECOMPUTE_CHUNK = int(os.getenv('LEVEL_RECOMPUTE_CHUNK', 1000))  # Users read & updated per statement by recomputeLevels
+
+# Coin ledger settings
+LEDGER_SNAPSHOT_INTERVAL = float(os.getenv('LEDGER_SNAPSHOT_INTERVAL', 3600))  # Seconds between reconciliations/snapshots
+LEDGER_CHUNK_SIZE = int(os.getenv('LEDGER_CHUNK_SIZE', 1000))  # Users reconciled per query
+
+# Poll settings
+POLL_EDIT_INTERVAL = float(os.getenv('POLL_EDIT_INTERVAL', 5))  # Seconds between tally edits of one poll's message
+POLL_FLUSH_INTERVAL = float(os.getenv('POLL_FLUSH_INTERVAL', 10))  # Seconds between vote tally writes
+POLL_DURATION = float(os.getenv('POLL_DURATION', 1440))  # Minutes a poll stays open (0 = until closed by hand)
+
+# Purge settings (?clear)
+PURGE_MAX = int(os.getenv('PURGE_MAX', 1000))  # Most messages one clear can delete
+PURGE_SCAN_LIMIT = int(os.getenv('PURGE_SCAN_LIMIT', 10000))  # Most messages one clear looks through (filters can skip many)
+PURGE_OLD_DELAY = float(os.getenv('PURGE_OLD_DELAY', 1.2))  # Seconds between deletes of messages too old to bulk delete
+PURGE_PROGRESS_INTERVAL = float(os.getenv('PURGE_PROGRESS_INTERVAL', 5))  # Seconds between progress updates
+
+# Metrics settings
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # Interface the /metrics endpoint listens on
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))  # Port of the /metrics endpoint (0 = off)
+METRICS_LAG_INTERVAL = float(os.getenv('METRICS_LAG_INTERVAL', 1))  # Seconds between event loop lag samples
+
+# User cache settings
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1000))  # Max users kept in memory
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))  # Seconds before a cached user is re-read (0 = never)
+
 # Global variables
-message_count = 0
-channel_message_count = {}
+shard_messages = {}  # shard id -> messages seen by the shard since startup
+gateway_events = {}  # event type -> gateway events received since the last report (measurement mode)
+
+# Write-behind buffers (flushed by flushCounters)
+pending_xp = {}  # (guild_id, user_id) -> XP not yet written to the database
+pending_xp_channel = {}  # (guild_id, user_id) -> channel id of the last message (for level up messages)
+pending_messages = {}  # channel id -> messages not yet written
+pending_events = 0  # Number of events buffered since the last flush
+pending_since = None  # time.monotonic() of the oldest buffered event
+flush_lock = asyncio.Lock()
+flush_wakeup = asyncio.Event()
+flush_task = None
+
+# Message XP cooldowns ((guild_id, user_id) -> time.monotonic() of the last award), swept once per window
+xp_cooldowns = {}
+xp_cooldowns_swept = 0.0
+
+# Open polls in this process's shards (message id -> LivePoll), loaded in setup_hook
+live_polls = {}
+poll_flush_task = None
+
+# Running clears (channel id -> PurgeJob), one per channel
+purge_jobs = {}
+
+# Ledger reconciliation task (started in setup_hook)
+ledger_task = None
+
+# Channel registry (channel id -> Channel row), loaded once at startup
+channel_registry = {}
+channel_registry_loaded = False
+
+# Database health check task (started in setup_hook)
+db_health_task = None
+
+# level_rank persistence task (started in setup_hook)
+rank_persist_task = None
+
+# Shared HTTP session (opened in setup_hook, closed on shutdown)
+http_session = None
+http_limit = asyncio.Semaphore(HTTP_MAX_CONCURRENCY)
+
+# Metrics endpoint & event loop lag sampler (started in setup_hook)
+metrics_runner = None
+metrics_lag_task = None
+
+# Chart rendering pool (each render has its own Figure, so renders never share state)
+chart_executor = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix='chart')
+charting = None  # matplotlib classes, imported on first use (see loadCharting)
+
+
+# Bot with a clean startup & shutdown (buffered counters are written before disconnecting)
+# The database is connected once here, before any gateway events are dispatched
+class Bot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        startup_marks['logged_in'] = time.perf_counter()  # setup_hook runs right after the gateway login
+        openHttpSession()
+        await startMetricsServer()
+        await connectToDB()
+        await loadChannelRegistry()  # Load known channels
+        await loadRankIndex()  # Rank every user by XP
+        await loadPolls()  # Polls to count votes for
+        startRankPersister()
+        startCounterFlusher()  # Start writing buffered XP & message counts
+        startDatabaseHealthCheck()
+        startLedgerSnapshots()
+        startPollFlusher()  # Start writing vote tallies
+        if MEASURE_INTERVAL:
+            asyncio.create_task(measureLoop())
+        startup_marks['setup'] = time.perf_counter()
+
+    async def close(self):
+        stopLedgerSnapshots()
+        await stopCounterFlusher()
+        await stopRankPersister()
+        await stopPollFlusher()
+        await disconnectFromDB()
+        await closeHttpSession()
+        await stopMetricsServer()
+        chart_executor.shutdown(wait=False)
+        await super().close()
+
+    # Every command & event handler is timed (see instrumentHandler)
+    def command(self, *args, **kwargs):
+        decorator = super().command(*args, **kwargs)
+        return lambda func: decorator(instrumentHandler('command', func))
+
+    def event(self, coro):
+        return super().event(instrumentHandler('event', coro))
+
+
+# Intents the handlers actually use, everything else (presences, typing, voice...) is never sent to us
+def buildIntents():
+    if INTENTS_PROFILE == 'all':
+        return discord.Intents.all()
+
+    intents = discord.Intents.none()
+    intents.guilds = True  # Guild & channel info
+    intents.guild_messages = True  # on_message & commands
+    intents.dm_messages = True  # Commands in DMs
+    intents.message_content = True  # Reading command text
+    intents.members = True  # on_member_join & member arguments
+    intents.guild_reactions = True  # Poll votes
+    return intents
+
+
+# Only cache members as they join instead of every member of every guild
+def buildMemberCacheFlags(intents):
+    if INTENTS_PROFILE == 'all':
+        return discord.MemberCacheFlags.from_intents(intents)
+
+    flags = discord.MemberCacheFlags.none()
+    flags.joined = True
+    return flags
+
 
 # Create intents & bot
-bot = commands.Bot(command_prefix="?", intents=discord.Intents.all())  # Create bot
+intents = buildIntents()
+bot = Bot(
+    command_prefix="?",
+    intents=intents,
+    member_cache_flags=buildMemberCacheFlags(intents),
+    chunk_guilds_at_startup=INTENTS_PROFILE == 'all',  # Member lists are fetched on demand instead
+    enable_debug_events=MEASURE_INTERVAL > 0,  # Needed for on_socket_event_type
+    shard_count=SHARD_COUNT,
+    shard_ids=SHARD_IDS
+)  # Create bot
+
+
+# Resident memory of the bot in bytes
+def currentRss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak RSS where /proc isn't available
+
+
+# Measurement mode - Print RSS & gateway events/sec every interval (compare INTENTS_PROFILE=all with minimal)
+async def measureLoop():
+    while True:
+        await asyncio.sleep(MEASURE_INTERVAL)
+        events = dict(gateway_events)
+        gateway_events.clear()
+
+        busiest = sorted(events.items(), key=lambda item: item[1], reverse=True)[:5]
+        print(f'Measure ({INTENTS_PROFILE}): RSS {currentRss() / 1024 / 1024:.1f} MiB | '
+              f'{sum(events.values()) / MEASURE_INTERVAL:.1f} events/s | '
+              f'{len(bot.users)} cached users | '
+              + ', '.join(f'{event_type} {count / MEASURE_INTERVAL:.1f}/s' for event_type, count in busiest))
+
+
+# Check if a guild belongs to one of the shards this process runs (Discord's guild_id >> 22 % shard_count)
+def ownsGuild(guild_id):
+    return SHARD_IDS is None or guild_id is None or (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+
+# SQL condition limiting a guild_id column to this process's shards
+def shardFilterSql(column):
+    if SHARD_IDS is None:
+        return 'TRUE'
+    return f'({column} >> 22) % {SHARD_COUNT} IN ({", ".join(str(shard) for shard in SHARD_IDS)})'
+
+
+'''
+    METRICS
+'''
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # Seconds
+
+
+# Label set in the exposition format, e.g. {kind="command",name="roll"}
+def formatLabels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+# Counter per label set (labels are tuples of (name, value) pairs)
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{formatLabels(labels)} {value}' for labels, value in self.values.items()]
+        return lines
+
+
+# Latency histogram per label set, with Prometheus-style cumulative buckets
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}  # labels -> [count per bucket (the last one is +Inf), sum, count]
+
+    def observe(self, labels, seconds):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{formatLabels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{formatLabels(labels)} {series[-2]}')
+            lines.append(f'{self.name}_count{formatLabels(labels)} {series[-1]}')
+        return lines
+
+
+handler_seconds = Histogram('bot_handler_seconds', 'Command & event handler latency in seconds')
+handler_errors = Counter('bot_handler_errors_total', 'Command & event handlers that raised')
+handler_queries = Counter('bot_handler_db_queries_total', 'Database calls made by each handler')
+db_seconds = Histogram('bot_db_query_seconds', 'Database call latency in seconds')
+db_errors = Counter('bot_db_errors_total', 'Database calls that raised')
+loop_lag = Histogram('bot_event_loop_lag_seconds', 'How late the event loop woke a sleeping task')
+xp_suppressed = Counter('bot_xp_awards_suppressed_total', 'Message XP awards skipped by the per-user cooldown')
+
+# Handler running in the current task, so database calls can be counted against it
+current_handler = contextvars.ContextVar('current_handler', default=(('kind', 'task'), ('name', 'background')))
+
+
+# Time a command or event handler, counting its errors & database calls
+def instrumentHandler(kind, func):
+    labels = (('kind', kind), ('name', func.__name__))
+
+    @functools.wraps(func)  # Keeps the signature (command arguments) & checks
+    async def handler(*args, **kwargs):
+        token = current_handler.set(labels)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(labels)
+            raise
+        finally:
+            handler_seconds.observe(labels, time.perf_counter() - started)
+            current_handler.reset(token)
+
+    return handler
+
+
+# Time a database call & count it against the handler that made it
+def instrumentQuery(name, call):
+    labels = (('query', name),)
+
+    async def query(*args, **kwargs):
+        handler_queries.inc(current_handler.get())
+        started = time.perf_counter()
+        try:
+            return await call(*args, **kwargs)
+        except Exception:
+            db_errors.inc(labels)
+            raise
+        finally:
+            db_seconds.observe(labels, time.perf_counter() - started)
+
+    return query
+
+
+# Batch whose commit (one round trip for every queued operation) is timed
+class InstrumentedBatch:
+    def __init__(self, batch):
+        self.batch = batch
+        self.commit = instrumentQuery('batch_', self.batch.__aexit__)
+
+    async def __aenter__(self):
+        return await self.batch.__aenter__()
+
+    async def __aexit__(self, *exc_info):
+        if exc_info[0] is not None:
+            return await self.batch.__aexit__(*exc_info)  # Nothing is sent
+        return await self.commit(*exc_info)
+
+
+# Model (prisma.user, prisma.channel...) whose actions are timed as e.g. user.find_unique
+class InstrumentedModel:
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+
+    def __getattr__(self, action):
+        call = instrumentQuery(f'{self.name}.{action}', getattr(self.model, action))
+        setattr(self, action, call)
+        return call
+
+
+# Prisma client with every query, model action & batch timed, everything else (connect...) is passed through
+class InstrumentedPrisma:
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name in ('query_raw', 'query_first', 'execute_raw'):
+            attribute = instrumentQuery(name, attribute)
+        elif name == 'batch_':
+            batch = attribute
+            attribute = lambda: InstrumentedBatch(batch())
+        elif hasattr(attribute, 'find_many'):
+            attribute = InstrumentedModel(name, attribute)
+        else:
+            return attribute
+        setattr(self, name, attribute)
+        return attribute
+
+
+# Sample how late the event loop wakes a task (time spent blocked by synchronous work)
+async def loopLagLoop():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(METRICS_LAG_INTERVAL)
+        loop_lag.observe((), max(0.0, time.perf_counter() - started - METRICS_LAG_INTERVAL))
+
+
+# Every metric in the Prometheus text format
+def renderMetrics():
+    lines = []
+    for metric in (handler_seconds, handler_errors, handler_queries, db_seconds, db_errors, loop_lag, xp_suppressed):
+        lines += metric.render()
+
+    lines += ['# HELP bot_gateway_latency_seconds Heartbeat latency of each shard',
+              '# TYPE bot_gateway_latency_seconds gauge']
+    for shard_id, latency in bot.latencies:
+        if latency == latency and latency != float('inf'):  # nan/inf until the first heartbeat
+            lines.append(f'bot_gateway_latency_seconds{formatLabels((("shard", shard_id),))} {latency}')
+
+    users = user_cache.stats()
+    lines += ['# HELP bot_pending_events Events buffered for the next counter flush',
+              '# TYPE bot_pending_events gauge', f'bot_pending_events {pending_events}',
+              '# HELP bot_user_cache_lookups_total User cache lookups by result',
+              '# TYPE bot_user_cache_lookups_total counter',
+              f'bot_user_cache_lookups_total{{result="hit"}} {users["hits"]}',
+              f'bot_user_cache_lookups_total{{result="miss"}} {users["misses"]}']
+
+    charts = chart_cache.stats()
+    lines += ['# HELP bot_chart_cache_lookups_total Chart cache lookups by result',
+              '# TYPE bot_chart_cache_lookups_total counter',
+              f'bot_chart_cache_lookups_total{{result="hit"}} {charts["hits"]}',
+              f'bot_chart_cache_lookups_total{{result="miss"}} {charts["misses"]}',
+              '# HELP bot_chart_cache_hit_ratio Share of chart cache lookups that were hits since startup',
+              '# TYPE bot_chart_cache_hit_ratio gauge', f'bot_chart_cache_hit_ratio {charts["hit_rate"]}',
+              '# HELP bot_chart_cache_bytes Size of the cached chart PNGs',
+              '# TYPE bot_chart_cache_bytes gauge', f'bot_chart_cache_bytes {charts["bytes"]}']
+
+    # Stale responses are misses that fell back on an expired response because upstream failed or was slow
+    lines += ['# HELP bot_api_cache_lookups_total API response cache lookups by result',
+              '# TYPE bot_api_cache_lookups_total counter',
+              f'bot_api_cache_lookups_total{{result="hit"}} {api_cache.hits}',
+              f'bot_api_cache_lookups_total{{result="miss"}} {api_cache.misses}',
+              '# HELP bot_api_cache_stale_total API cache misses answered with a stale response',
+              '# TYPE bot_api_cache_stale_total counter', f'bot_api_cache_stale_total {api_cache.stale}']
+    return '\n'.join(lines) + '\n'
+
+
+async def metricsEndpoint(request):
+    return web.Response(body=renderMetrics().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# Serve /metrics & start sampling the event loop lag (once, from setup_hook)
+async def startMetricsServer():
+    global metrics_runner, metrics_lag_task
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get('/metrics', metricsEndpoint)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        await runner.cleanup()
+        print(f'Metrics: Could not listen on {METRICS_HOST}:{METRICS_PORT} ({e}), metrics are off')
+        return
+
+    metrics_runner = runner
+    metrics_lag_task = asyncio.create_task(loopLagLoop())
+    print(f'Metrics: Serving http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+
+
+async def stopMetricsServer():
+    global metrics_runner, metrics_lag_task
+    if metrics_lag_task is not None:
+        metrics_lag_task.cancel()
+        metrics_lag_task = None
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
 
+# Database URL with the connection pool settings applied
+def databaseUrl():
+    params = []
+    if DB_POOL_SIZE:
+        params.append(f'connection_limit={int(DB_POOL_SIZE)}')
+    if DB_POOL_TIMEOUT:
+        params.append(f'pool_timeout={int(DB_POOL_TIMEOUT)}')
+    if not params:
+        return DATABASE_URL
+    return DATABASE_URL + ('&' if '?' in DATABASE_URL else '?') + '&'.join(params)
 
-# Create Prisma instance & connect to DB
+
+# Create Prisma instance (connected once in setup_hook and reused across gateway reconnects)
+# Every database call goes through the metrics wrapper
+prisma = InstrumentedPrisma(Prisma(datasource={'url': databaseUrl()}) if DATABASE_URL else Prisma())
+
+
+# Connect to DB, retrying with exponential backoff
 async def connectToDB():
-    global prisma
-    prisma = Prisma()
-    await prisma.connect()
+    started = time.perf_counter()
+    delay = 1
+    while True:
+        try:
+            await prisma.connect()
+            break
+        except Exception as e:
+            print(f'Prisma: Failed to connect ({e}), retrying in {delay}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_RECONNECT_MAX_DELAY)
+
+    startup_marks.setdefault('db_connect', time.perf_counter() - started)
     print('Prisma: Connected to Railway')
 
 
+# Drop the (broken) connection and connect again
+async def reconnectToDB():
+    try:
+        await prisma.disconnect()
+    except Exception as e:
+        print(f'Prisma: Failed to disconnect cleanly ({e})')
+    await connectToDB()
+
+
+# Check the connection every interval, reconnecting when a check fails
+async def databaseHealthLoop():
+    while True:
+        await asyncio.sleep(DB_HEALTH_INTERVAL)
+        try:
+            await asyncio.wait_for(prisma.query_raw('SELECT 1'), timeout=DB_HEALTH_TIMEOUT)
+        except Exception as e:
+            print(f'Prisma: Health check failed ({str(e) or "timed out"}), reconnecting')
+            await reconnectToDB()
+
+
+def startDatabaseHealthCheck():
+    global db_health_task
+    if db_health_task is None:
+        db_health_task = asyncio.create_task(databaseHealthLoop())
+
+
+# Stop the health checks and close the connection (after the counters are flushed)
+async def disconnectFromDB():
+    global db_health_task
+    if db_health_task is not None:
+        db_health_task.cancel()
+        db_health_task = None
+    if prisma.is_connected():
+        await prisma.disconnect()
+        print('Prisma: Disconnected')
+
+
+# Print how long each startup phase took (once, on the first on_ready)
+def printStartupReport():
+    if 'reported' in startup_marks:
+        return
+    startup_marks['reported'] = time.perf_counter()
+
+    marks = startup_marks
+    print('Startup: '
+          f'imports {marks["imported"] - marks["started"]:.2f}s | '
+          f'gateway login {marks["logged_in"] - marks["imported"]:.2f}s | '
+          f'gateway ready {marks["ready"] - marks["setup"]:.2f}s | '
+          f'DB connect {marks["db_connect"]:.2f}s | '
+          f'total {marks["reported"] - marks["started"]:.2f}s')
+
+
+# Database key of a member (users are stored per guild, by their snowflake IDs)
+def userKey(member):
+    return (member.guild.id, member.id)
+
+
+# Prisma where clause for a user key
+def userWhere(key):
+    return {'guild_id_user_id': {'guild_id': key[0], 'user_id': key[1]}}
+
+
+# Key of a user row (raw query rows return BigInt columns as they come)
+def rowKey(row):
+    return (int(row['guild_id']), int(row['user_id']))
+
+
 # Function to add user to database
-async def createUser(username):
+async def createUser(member):
     # Create database entry for user
-    await prisma.user.create(
-        data={'username': username}  # Set username as Discord name (Ryan#1234)}
+    user = await prisma.user.create(
+        data={
+            'guild_id': member.guild.id,
+            'user_id': member.id,
+            'username': member.name  # Display name only, users are looked up by ID
+        }
     )
+    cacheUser(user)
     # Success message (terminal only)
-    print(f'Prisma: Created new entry for {username}')
+    print(f'Prisma: Created new entry for {member.name}')
+
+
+# Make sure a member has a row: rows are created on join, so members from before the bot joined get one here
+# Every row in this process's guilds is in the rank index, so only members without a row touch the database
+async def ensureUser(member):
+    key = userKey(member)
+    if key[1] in rankIndex(key[0]).users:
+        return
+
+    user = await prisma.user.upsert(
+        where=userWhere(key),
+        data={
+            'create': {'guild_id': key[0], 'user_id': key[1], 'username': member.name},
+            'update': {},  # Created meanwhile (e.g. by on_member_join), keep it as it is
+        },
+    )
+    cacheUser(user)
+
+
+'''
+    USER CACHE
+'''
+
+
+# LRU cache of user rows keyed by (guild_id, user_id), kept up to date by every XP/coin write
+class UserCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (guild_id, user_id) -> (expires at, user)
+        self.hits = 0
+        self.misses = 0
+
+    # Get a cached user, or None if it isn't cached (or has expired)
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or (self.ttl and entry[0] < time.monotonic()):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)  # Mark as recently used
+        self.hits += 1
+        return entry[1]
+
+    # Cache a user, evicting the least recently used user when full
+    def put(self, user):
+        key = (user.guild_id, user.user_id)
+        self.entries[key] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    # Get a cached user without counting a hit/miss or marking it as used
+    def peek(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry[1]
+
+    # Update fields of a cached user (users that aren't cached are left alone)
+    def update(self, key, **fields):
+        entry = self.entries.get(key)
+        if entry is not None:
+            for name, value in fields.items():
+                setattr(entry[1], name, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# Convert a Prisma user (or a raw query row) to the plain object we keep in the cache
+def toCachedUser(user):
+    if isinstance(user, dict):
+        user = SimpleNamespace(**user)
+    return SimpleNamespace(
+        guild_id=int(user.guild_id),
+        user_id=int(user.user_id),
+        username=user.username,
+        xp=user.xp,
+        level=user.level,
+        coins=user.coins,
+        level_rank=user.level_rank,
+    )
+
+
+# Get a user from the cache, reading from the database on a miss
+async def getUser(key):
+    user = user_cache.get(key)
+    if user is not None:
+        return user
+
+    user = await prisma.user.find_unique(
+        where=userWhere(key),  # Find user in database
+    )
+    if user is None:
+        return None
+
+    return cacheUser(user)
+
+
+# Write a freshly read/written user row through to the cache
+def cacheUser(user):
+    if user is None:
+        return None
+
+    user = toCachedUser(user)
+    rankIndex(user.guild_id).set(user.user_id, user.xp, user.level, user.username)  # Ranked by the XP in the database
+    user.xp += pending_xp.get((user.guild_id, user.user_id), 0)  # Include XP that is still buffered
+    user_cache.put(user)
+    return user
+
+
+'''
+    RANK INDEX
+'''
+
+
+# Every user in a guild ordered by XP (highest first, ties by user ID), kept up to date on every XP change
+class RankIndex:
+    def __init__(self):
+        self.users = {}  # user_id -> (xp, level, username)
+        self.order = []  # Sorted (-xp, user_id) keys
+
+    # Set a user's XP & level, moving them to their new position
+    def set(self, user_id, xp, level, username):
+        old = self.users.get(user_id)
+        if old is not None:
+            if old[0] == xp:
+                self.users[user_id] = (xp, level, username)
+                return
+            del self.order[bisect_left(self.order, (-old[0], user_id))]
+        insort(self.order, (-xp, user_id))
+        self.users[user_id] = (xp, level, username)
+
+    # 1-based rank of a user, or None if they aren't ranked
+    def rank(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is None:
+            return None
+        return bisect_left(self.order, (-entry[0], user_id)) + 1
+
+    # The k highest ranked users as (username, xp, level)
+    def top(self, k, start=0):
+        return [(self.users[user_id][2], -xp, self.users[user_id][1]) for xp, user_id in self.order[start:start + k]]
+
+    def __len__(self):
+        return len(self.order)
+
+
+rank_indexes = {}  # guild_id -> RankIndex
+persisted_ranks = {}  # (guild_id, user_id) -> level_rank currently stored in the database
+
+
+# Rank index of a guild
+def rankIndex(guild_id):
+    if guild_id not in rank_indexes:
+        rank_indexes[guild_id] = RankIndex()
+    return rank_indexes[guild_id]
+
+
+# Rank every user in this process's shards, reading the table in chunks
+async def loadRankIndex():
+    cursor = (0, 0)
+    count = 0
+    while True:
+        users = await prisma.query_raw(
+            f'''
+            SELECT guild_id, user_id, username, xp, level, level_rank FROM "User"
+            WHERE (guild_id, user_id) > ($1::bigint, $2::bigint) AND {shardFilterSql('guild_id')}
+            ORDER BY guild_id, user_id
+            LIMIT 1000
+            ''',
+            *cursor
+        )
+        for user in users:
+            key = rowKey(user)
+            rankIndex(key[0]).set(key[1], user['xp'], user['level'], user['username'])
+            persisted_ranks[key] = user['level_rank']
+        count += len(users)
+        if len(users) < 1000:
+            break
+        cursor = rowKey(users[-1])
+
+    print(f'Prisma: Ranked {count} users in {len(rank_indexes)} guilds')
+
+
+# Write level_rank for every user whose rank changed since the last write
+async def persistRanks():
+    changed = []
+    for guild_id, index in rank_indexes.items():
+        for position, (_, user_id) in enumerate(index.order, start=1):
+            if persisted_ranks.get((guild_id, user_id)) != position:
+                changed.append(((guild_id, user_id), position))
+
+    for start in range(0, len(changed), RANK_PERSIST_BATCH):
+        chunk = changed[start:start + RANK_PERSIST_BATCH]
+        async with prisma.batch_() as batcher:
+            for key, position in chunk:
+                batcher.user.update_many(
+                    where={'guild_id': key[0], 'user_id': key[1]},
+                    data={'level_rank': position}
+                )
+        for key, position in chunk:
+            persisted_ranks[key] = position
+            user_cache.update(key, level_rank=position)
+
+    if changed:
+        print(f'Prisma: Updated level_rank for {len(changed)} users')
+
+
+async def rankPersistLoop():
+    while True:
+        await asyncio.sleep(RANK_PERSIST_INTERVAL)
+        try:
+            await persistRanks()
+        except Exception as e:
+            print(f'Prisma: Failed to update level_rank, retrying next interval ({e})')
+
+
+def startRankPersister():
+    global rank_persist_task
+    if rank_persist_task is None:
+        rank_persist_task = asyncio.create_task(rankPersistLoop())
+
+
+# Stop the persister and write the final ranks
+async def stopRankPersister():
+    global rank_persist_task
+    if rank_persist_task is None:
+        return
+    rank_persist_task.cancel()
+    rank_persist_task = None
+    try:
+        await persistRanks()
+    except Exception as e:
+        print(f'Prisma: Failed to update level_rank on shutdown ({e})')
+
+
+'''
+    WRITE-BEHIND COUNTERS
+'''
+
+
+# Queue XP for a member, written to the database by the next flush
+def queueXp(member, xp, channel_id):
+    key = userKey(member)
+    pending_xp[key] = pending_xp.get(key, 0) + xp
+    pending_xp_channel[key] = channel_id
+    cached = user_cache.peek(key)
+    if cached is not None:
+        cached.xp += xp  # Cached XP includes buffered XP
+    # Ranks only move when the XP is written, so the index orders users exactly like the leaderboard query
+    notePendingEvent()
+
+
+# Check (and start) a member's message XP cooldown, counting the awards it suppresses
+def xpOnCooldown(member):
+    global xp_cooldowns_swept
+    if not XP_COOLDOWN:
+        return False
+
+    # Forget cooldowns that have ended, so only users active in the last window are kept
+    now = time.monotonic()
+    if now - xp_cooldowns_swept >= XP_COOLDOWN:
+        for key in [key for key, awarded in xp_cooldowns.items() if now - awarded >= XP_COOLDOWN]:
+            del xp_cooldowns[key]
+        xp_cooldowns_swept = now
+
+    key = userKey(member)
+    awarded = xp_cooldowns.get(key)
+    if awarded is not None and now - awarded < XP_COOLDOWN:
+        xp_suppressed.inc()
+        return True
+    xp_cooldowns[key] = now
+    return False
+
+
+# Queue a message for a registered channel, written to the database by the next flush
+def queueChannelMessage(channel_id):
+    pending_messages[channel_id] = pending_messages.get(channel_id, 0) + 1
+    notePendingEvent()
+
+
+# Track the buffer size & age, waking the flusher early when the buffer is full
+def notePendingEvent():
+    global pending_events, pending_since
+    pending_events += 1
+    if pending_since is None:
+        pending_since = time.monotonic()
+    if pending_events >= COUNTER_FLUSH_MAX_EVENTS:
+        flush_wakeup.set()
+
+
+# Check if the oldest buffered event is older than the allowed staleness
+def countersAreStale():
+    return pending_since is not None and time.monotonic() - pending_since > COUNTER_MAX_STALENESS_MS / 1000
+
+
+# Write all buffered XP (one statement per chunk of users) & message counts (one transaction) to the database
+# Returns False if anything failed & was requeued for the next flush
+async def flushCounters():
+    global pending_xp, pending_xp_channel, pending_messages, pending_events, pending_since
+
+    async with flush_lock:
+        if pending_events == 0:
+            return True
+
+        # Swap the buffers so new events can be queued while we write
+        xp, xp_channels, messages = pending_xp, pending_xp_channel, pending_messages
+        events, since = pending_events, pending_since
+        pending_xp, pending_xp_channel, pending_messages = {}, {}, {}
+        pending_events, pending_since = 0, None
+
+        # Put the counts back so they are retried by the next flush
+        def requeue(xp, messages):
+            global pending_events, pending_since
+            for key, amount in xp.items():
+                pending_xp[key] = pending_xp.get(key, 0) + amount
+                pending_xp_channel.setdefault(key, xp_channels[key])
+            for channel_id, count in messages.items():
+                pending_messages[channel_id] = pending_messages.get(channel_id, 0) + count
+            pending_events += len(xp) + len(messages)
+            pending_since = since if pending_since is None else min(since, pending_since)
+
+        # XP & levels with one statement per chunk of users, only failed chunks are retried
+        # (a backlog built up during an outage can't grow past what one statement can take)
+        awarded = []
+        failed = {}
+        keys = list(xp)
+        for start in range(0, len(keys), COUNTER_FLUSH_CHUNK):
+            chunk = {key: xp[key] for key in keys[start:start + COUNTER_FLUSH_CHUNK]}
+            try:
+                rows = await awardXpBatch(chunk)
+            except Exception as e:
+                failed.update(chunk)
+                print(f'Prisma: Failed to flush XP for {len(chunk)} users, retrying next flush ({e})')
+                continue
+
+            # Refresh the cache & rank index right away, so leaderboard cursors match the database
+            # (XP buffered while we were writing is kept by cacheUser)
+            for row in rows:
+                cacheUser(row)
+            awarded += rows
+        if failed:
+            requeue(failed, {})
+
+        # Channel message counts in one transaction
+        channels_written = True
+        try:
+            async with prisma.batch_() as batcher:
+                for channel_id, count in messages.items():
+                    batcher.channel.update_many(
+                        where={'id': channel_id},  # Channels are registered before their first message is queued
+                        data={'messages': {'increment': count}},
+                    )
+        except Exception as e:
+            # The XP is already written (apart from failed chunks), only the channel counts are retried
+            requeue({}, messages)
+            channels_written = False
+            print(f'Prisma: Failed to flush channel counts, retrying next flush ({e})')
+        else:
+            for channel_id, count in messages.items():
+                channel_registry[channel_id].messages += count
+
+            # Success message (terminal only)
+            print(f'Prisma: Flushed {events} buffered events ({len(xp)} users, {len(messages)} channels)')
+
+    # Announce level ups outside the lock so Discord latency doesn't hold up the next flush
+    # (the XP is already written, so a failed announcement only skips that one message)
+    for row in awarded:
+        if row['level'] > row['old_level']:
+            try:
+                await announceLevelUp(row['username'], row['level'], xp_channels[rowKey(row)])
+            except discord.HTTPException as e:
+                print(f'Prisma: Failed to announce {row["username"]}\'s level up ({e})')
+
+    return channels_written and not failed
+
+
+# Background task that flushes the counters every interval (or early when the buffer is full)
+async def counterFlushLoop():
+    while True:
+        try:
+            await asyncio.wait_for(flush_wakeup.wait(), timeout=COUNTER_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        flush_wakeup.clear()
+
+        try:
+            written = await flushCounters()
+        except Exception as e:
+            written = False
+            print(f'Prisma: Failed to flush counters, retrying next interval ({e})')
+
+        # A stale buffer wakes us on every message, so wait out the interval before retrying a failed flush
+        if not written:
+            await asyncio.sleep(COUNTER_FLUSH_INTERVAL_MS / 1000)
+
+
+# Start the flusher (once, from setup_hook)
+def startCounterFlusher():
+    global flush_task
+    if flush_task is None:
+        flush_task = asyncio.create_task(counterFlushLoop())
+
+
+# Stop the flusher and write whatever is still buffered
+async def stopCounterFlusher():
+    global flush_task
+    if flush_task is None:
+        return
+    flush_task.cancel()
+    flush_task = None
+    try:
+        await flushCounters()
+    except Exception as e:
+        print(f'Prisma: Failed to flush counters on shutdown ({e})')
+
+
+'''
+    HTTP CLIENT
+'''
+
+
+# Open the pooled keep-alive session used for every API request
+def openHttpSession():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+
+
+async def closeHttpSession():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+
+# Cache of API responses with per-key TTLs, request coalescing & stale-while-revalidate
+class ResponseCache:
+    def __init__(self, max_size, stale_ttl, stale_wait):
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self.stale_wait = stale_wait
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.inflight = {}  # key -> task fetching the key from upstream
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    # Get a response, calling fetch() (once, however many callers are waiting) when it's missing or expired
+    # fetch() raises one of FETCH_ERRORS for a failed response, failures are never cached
+    async def get(self, key, fetch, ttl):
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.refresh(key, fetch, ttl))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # Errors are handled by the waiters
+            self.inflight[key] = task
+
+        # Nothing to fall back on, wait for upstream
+        if entry is None or entry[0] + self.stale_ttl < now:
+            return await asyncio.shield(task)
+
+        # Serve the stale response if upstream is slow, down or answering with errors
+        # (a slow refresh carries on in the background)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=self.stale_wait)
+        except FETCH_ERRORS:
+            self.stale += 1
+            return entry[1]
+
+    # Only a good response replaces the cached one
+    async def refresh(self, key, fetch, ttl):
+        try:
+            value = await fetch()
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+
+api_cache = ResponseCache(API_CACHE_SIZE, API_CACHE_STALE_TTL, API_CACHE_STALE_WAIT)
+
+
+# An API answered with an error (non-2xx status, a body that isn't JSON or an error payload)
+class ApiError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# Everything fetchJson can raise when a request fails
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ApiError)
+
+
+# Error message of an API's JSON error payload (weatherapi.com: {"error": {"message"}}, newsapi.org: {"status": "error"})
+def apiErrorMessage(data):
+    if not isinstance(data, dict):
+        return None
+    if isinstance(data.get('error'), dict):
+        return data['error'].get('message') or 'the API returned an error'
+    if data.get('status') == 'error':
+        return data.get('message') or 'the API returned an error'
+    return None
+
+
+# Fetch a JSON API response without blocking the event loop, raising ApiError for anything but a good response
+async def fetchJson(url, params=None):
+    async with http_limit:
+        async with http_session.get(url, params=params) as response:
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = None  # HTML error pages from proxies & load balancers
+            status = response.status
+
+    message = apiErrorMessage(data)
+    if not 200 <= status < 300:
+        raise ApiError(message or f'the API returned HTTP {status}', status)
+    if data is None:
+        raise ApiError('the API returned a response that isn\'t JSON', status)
+    if message is not None:
+        raise ApiError(message, status)
+    return data
+
+
+'''
+    CHANNEL REGISTRY
+'''
+
+
+# Load every channel into the registry (once, from setup_hook)
+async def loadChannelRegistry():
+    global channel_registry_loaded
+    if channel_registry_loaded:
+        return
+
+    for channel in await prisma.channel.find_many():
+        if ownsGuild(channel.guild_id):
+            channel_registry[channel.id] = SimpleNamespace(
+                id=channel.id, guild_id=channel.guild_id, name=channel.name, messages=channel.messages
+            )
+    channel_registry_loaded = True
+    print(f'Prisma: Loaded {len(channel_registry)} channels')
+
+
+# Make sure a channel has a row, only touching the database for new or renamed channels
+# (and for channels created before rows had a guild_id)
+async def registerChannel(channel):
+    known = channel_registry.get(channel.id)
+    if known is not None and known.name == channel.name and known.guild_id == channel.guild.id:
+        return
+
+    row = await prisma.channel.upsert(
+        where={'id': channel.id},
+        data={
+            'create': {'id': channel.id, 'guild_id': channel.guild.id, 'name': channel.name},
+            'update': {'guild_id': channel.guild.id, 'name': channel.name},
+        },
+    )
+    channel_registry[channel.id] = SimpleNamespace(id=row.id, guild_id=row.guild_id, name=row.name, messages=row.messages)
 
 
 # Actions for when the bot connects to Discord
 @bot.event
 async def on_ready():
-    await connectToDB()
+    startup_marks.setdefault('ready', time.perf_counter())
+    warmCharting()  # Import matplotlib in the background, off the startup path
     # Success message (terminal only)
     print(f'{bot.user} is now online.')
+    printStartupReport()
+
+
+# Count gateway events by type (only dispatched in measurement mode)
+@bot.event
+async def on_socket_event_type(event_type):
+    gateway_events[event_type] = gateway_events.get(event_type, 0) + 1
 
 
 # Actions for when a user joins the server
@@ -59,25 +1241,33 @@ async def on_member_join(member):
 # Actions for when a user sends a message
 @bot.event
 async def on_message(message):
-    global message_count
-
     # Check if message is from a bot
     if message.author.bot:
         return
 
-    await awardXp(message.author.name, 3, message.channel.id)  # (username, xp, channel_id)
+    # XP is per guild, so DMs only run commands
+    if message.guild is None:
+        await bot.process_commands(message)
+        return
 
-    # Get or create channel
-    channel = await prisma.channel.find_first(where={'id': message.channel.id})
-    if channel is None:
-        channel = await prisma.channel.create(
-            data={'id': message.channel.id, 'name': message.channel.name, 'messages': 1},
-        )
-    else:
-        channel = await prisma.channel.update(
-            where={'id': message.channel.id},
-            data={'messages': channel.messages + 1},
-        )
+    shard_messages[message.guild.shard_id] = shard_messages.get(message.guild.shard_id, 0) + 1
+
+    # Buffer XP & the channel message count, both are written by the next flush
+    # XP is only earned once per cooldown, so spam doesn't farm XP or add writes
+    if not xpOnCooldown(message.author):
+        try:
+            await ensureUser(message.author)  # The flush only awards XP to existing rows
+        except Exception as e:
+            print(f'Prisma: Failed to create an entry for {message.author.name}, retrying next message ({e})')
+        else:
+            queueXp(message.author, 3, message.channel.id)  # (member, xp, channel_id)
+    await registerChannel(message.channel)  # No-op unless the channel is new or renamed
+    queueChannelMessage(message.channel.id)
+
+    # Wake the flusher if it has fallen behind the max staleness (never flush inline, so a slow or
+    # failing database can't hold up commands)
+    if countersAreStale():
+        flush_wakeup.set()
 
     # continue
     await bot.process_commands(message)
@@ -85,11 +1275,179 @@ async def on_message(message):
 
 # Commands
 
-# Clear - Clears a specified amount of messages (cmd_clear)
+# Optional filters of ?clear, e.g. ?clear 50 user: @someone contains: free nitro after: 2024-01-01
+class PurgeFilters(commands.FlagConverter):
+    user: discord.User = None  # A user, not a member, so messages from people who left can be cleared
+    contains: str = None
+    before: str = None  # Message ID or date (YYYY-MM-DD)
+    after: str = None
+
+
+# History bound from a message ID or a date (dates are UTC)
+def purgeBound(value):
+    if value is None:
+        return None
+    if value.isdigit():
+        return discord.Object(id=int(value))
+    try:
+        bound = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise commands.BadArgument(f'{value} is not a message ID or a date (YYYY-MM-DD)')
+    return bound if bound.tzinfo else bound.replace(tzinfo=timezone.utc)
+
+
+# A clear running in the background
+class PurgeJob:
+    def __init__(self, ctx, amount, filters):
+        self.channel = ctx.channel
+        self.command_message = ctx.message  # Deleted with the first batch
+        self.amount = amount
+        self.user = filters.user
+        self.contains = filters.contains.lower() if filters.contains else None
+        self.before = purgeBound(filters.before) or ctx.message
+        self.after = purgeBound(filters.after)
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.status = 'Cleared'
+        self.progress = None  # Progress message
+        self.reported = time.monotonic()
+        self.task = None
+
+    def matches(self, message):
+        if self.user is not None and message.author.id != self.user.id:
+            return False
+        return self.contains is None or self.contains in message.content.lower()
+
+
+# Newest creation time that can no longer be bulk deleted (14 days ago, with a minute of margin)
+# Taken fresh every time, since a long clear can run while messages age past it
+def bulkDeleteCutoff():
+    return discord.utils.utcnow() - datetime.timedelta(days=14) + datetime.timedelta(minutes=1)
+
+
+# Page through the history (newest first), bulk deleting recent messages 100 at a time
+# Messages older than 14 days can't be bulk deleted, so they go to a paced queue deleted alongside
+async def runPurge(job):
+    old_messages = asyncio.Queue()
+    old_worker = asyncio.create_task(deleteOldMessages(job, old_messages))
+    batch = [job.command_message]
+
+    try:
+        async for message in job.channel.history(limit=PURGE_SCAN_LIMIT, before=job.before, after=job.after,
+                                                 oldest_first=False):
+            job.scanned += 1
+            if not job.matches(message):
+                continue
+
+            job.matched += 1
+            if message.created_at > bulkDeleteCutoff():
+                batch.append(message)
+                if len(batch) == 100:
+                    await deleteBatch(job, batch, old_messages)
+                    batch = []
+            else:
+                old_messages.put_nowait(message)
+
+            if job.matched >= job.amount:
+                break
+
+        if batch:
+            await deleteBatch(job, batch, old_messages)
+        old_messages.put_nowait(None)  # Nothing more to queue
+        await old_worker
+    except asyncio.CancelledError:
+        job.status = 'Cancelled'
+        raise
+    except discord.Forbidden:
+        job.status = 'Stopped, I am missing the permission to delete messages'
+    except discord.HTTPException as e:
+        job.status = f'Stopped, Discord returned an error ({e})'
+    finally:
+        old_worker.cancel()
+        purge_jobs.pop(job.channel.id, None)
+        await reportPurge(job, final=True)
+
+
+async def deleteBatch(job, messages, old_messages):
+    # Messages that aged past the cutoff while the batch filled go to the paced queue instead
+    cutoff = bulkDeleteCutoff()
+    for message in messages:
+        if message.created_at <= cutoff:
+            old_messages.put_nowait(message)
+    messages = [message for message in messages if message.created_at > cutoff]
+    if not messages:
+        return
+
+    try:
+        await job.channel.delete_messages(messages)  # One request for up to 100 messages
+    except discord.NotFound:
+        pass  # Already deleted
+    job.deleted += sum(1 for message in messages if message.id != job.command_message.id)
+    await reportPurge(job)
+
+
+# Delete queued old messages one at a time, spaced out to stay clear of the rate limit
+async def deleteOldMessages(job, old_messages):
+    while True:
+        message = await old_messages.get()
+        if message is None:
+            return
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+        job.deleted += 1
+        await reportPurge(job)
+        await asyncio.sleep(PURGE_OLD_DELAY)
+
+
+# Edit the progress message (at most once per PURGE_PROGRESS_INTERVAL until the clear is done)
+async def reportPurge(job, final=False):
+    if not final and time.monotonic() - job.reported < PURGE_PROGRESS_INTERVAL:
+        return
+    job.reported = time.monotonic()
+
+    if final:
+        text = f'{job.status}: deleted {job.deleted} messages ({job.scanned} looked through)'
+    else:
+        text = f'Clearing: deleted {job.deleted} of {job.amount} messages ({job.scanned} looked through)'
+    try:
+        await job.progress.edit(content=text, delete_after=10 if final else None)
+    except discord.HTTPException:
+        pass
+
+
+# Clear - Clears a specified amount of messages in the background, with optional filters (cmd_clear)
+# ?clear 50 | ?clear 50 user: @someone contains: spam before: 2024-01-31 after: 2024-01-01
 @bot.command()
+@commands.guild_only()
 # @commands.has_any_role("Moderator", "Administrator", "Owner")
-async def clear(ctx, amount: int):
-    await ctx.channel.purge(limit=amount + 1)  # Clear messages
+async def clear(ctx, amount: int, *, filters: PurgeFilters):
+    if not 1 <= amount <= PURGE_MAX:
+        await ctx.reply(f'You can clear between 1 and {PURGE_MAX} messages at a time')
+        return
+    if ctx.channel.id in purge_jobs:
+        await ctx.reply('A clear is already running in this channel, stop it with ?clearCancel')
+        return
+
+    job = PurgeJob(ctx, amount, filters)
+    job.progress = await ctx.send(f'Clearing {amount} messages...')
+    purge_jobs[ctx.channel.id] = job
+    job.task = asyncio.create_task(runPurge(job))  # Runs in the background so other commands aren't held up
+
+
+# Clear Cancel - Stops the clear running in this channel (cmd_clear_cancel)
+@bot.command()
+@commands.guild_only()
+# @commands.has_any_role("Moderator", "Administrator", "Owner")
+async def clearCancel(ctx):
+    job = purge_jobs.get(ctx.channel.id)
+    if job is None:
+        await ctx.reply('There is no clear running in this channel')
+        return
+    purge_jobs.pop(ctx.channel.id, None)  # In case it is cancelled before it started
+    job.task.cancel()
 
 
 # Hello - Says hello to the user (cmd_hello)
@@ -105,10 +1463,34 @@ async def ping(ctx):
     await ctx.reply(f'Pong! {round(bot.latency * 1000)}ms')  # Round latency
 
 
-# Total users in database (cmd_totalusers)
+# Shards - Displays the latency, guilds & messages seen by each shard in this process (cmd_shards)
+@bot.command()
+async def shards(ctx):
+    embed = discord.Embed(title='Shards', color=0x02F0FF)
+    for shard_id, shard in sorted(bot.shards.items()):
+        guilds = sum(1 for guild in bot.guilds if guild.shard_id == shard_id)
+        embed.add_field(name=f'Shard {shard_id}' + (' (this server)' if ctx.guild and ctx.guild.shard_id == shard_id else ''),
+                        value=f'{round(shard.latency * 1000)}ms | {guilds} servers | {shard_messages.get(shard_id, 0)} messages',
+                        inline=False)
+    await ctx.reply(embed=embed)
+
+
+# Cache stats - Displays the user & chart cache sizes and hit rates (cmd_cachestats)
+@bot.command()
+async def cachestats(ctx):
+    users = user_cache.stats()
+    charts = chart_cache.stats()
+    await ctx.reply(f'User cache: {users["size"]}/{USER_CACHE_SIZE} users | '
+                    f'{users["hits"]} hits | {users["misses"]} misses | {users["hit_rate"]:.1%} hit rate\n'
+                    f'Chart cache: {charts["size"]} charts ({charts["bytes"] // 1024}/{CHART_CACHE_BYTES // 1024} KiB) | '
+                    f'{charts["hits"]} hits | {charts["misses"]} misses | {charts["hit_rate"]:.1%} hit rate')
+
+
+# Total users of this guild in the database (cmd_totalusers)
 @bot.command()
+@commands.guild_only()
 async def totalusers(ctx):
-    totalUsers = await prisma.user.count()  # Count the number of users in the database
+    totalUsers = await prisma.user.count(where={'guild_id': ctx.guild.id})  # Rows are per guild, so count this guild's
     await ctx.reply(f'There are {totalUsers} users in the database')
 
 
@@ -119,6 +1501,7 @@ async def totalusers(ctx):
 
 # Ban - Bans a user (cmd_ban)
 @bot.command()
+@commands.guild_only()
 @commands.has_any_role("Moderator", "Administrator", "Owner")
 async def ban(ctx, member: discord.Member, *, reason: str = ""):
     if reason == "":
@@ -128,6 +1511,7 @@ async def ban(ctx, member: discord.Member, *, reason: str = ""):
 
 # Kick - Kicks a user (cmd_kick)
 @bot.command()
+@commands.guild_only()
 #@commands.has_any_role("Moderator", "Administrator", "Owner")
 async def kick(ctx, member: discord.Member, *, reason: str = ""):
     if reason == "":
@@ -137,6 +1521,7 @@ async def kick(ctx, member: discord.Member, *, reason: str = ""):
 
 # Mute - Mutes a user (cmd_mute)
 @bot.command()
+@commands.guild_only()
 # @commands.has_any_role("Moderator", "Administrator", "Owner")
 async def mute(ctx, member: discord.Member, timeLimit):
     # Filter seconds
@@ -187,6 +1572,7 @@ async def mute(ctx, member: discord.Member, timeLimit):
 
 # Unmute - Unmutes a user (cmd_unmute)
 @bot.command()
+@commands.guild_only()
 #@commands.has_any_role("Moderator", "Administrator", "Owner")
 async def unmute(ctx, member: discord.Member):
     await member.edit(timed_out_until=None)
@@ -240,9 +1626,18 @@ async def info(ctx):
         name="?pollResults",
         value="This command shows the results of a poll using the poll ID",
         inline=False)
+    embed.add_field(
+        name="?pollClose",
+        value="This command closes a poll using the poll ID (poll author or moderators)",
+        inline=False)
     embed.add_field(
         name="?clear",
-        value="This command clears a specified amount of messages",
+        value="This command clears a specified amount of messages, optionally only those matching "
+              "user:, contains:, before: or after:",
+        inline=False)
+    embed.add_field(
+        name="?clearCancel",
+        value="This command stops the clear running in the channel",
         inline=False)
     embed.add_field(
         name="?info",
@@ -261,8 +1656,8 @@ async def info(ctx):
         value="This command displays the xp of a user",
         inline=False)
     embed.add_field(
-        name="?leaderboard",
-        value="This command displays the top 10 users with the most xp",
+        name="?leaderboard [page number | me | around member]",
+        value="This command displays the users with the most xp, 10 at a time",
         inline=False)
     embed.add_field(
         name="?rank",
@@ -305,14 +1700,23 @@ async def info(ctx):
 # News - Displays the top three current articles from their api
 @bot.command()
 async def news(ctx):
-    url = 'https://newsapi.org/v2/top-headlines'
+    country = 'us'  # Country for the news
     params = {
-        'country': 'us',  # Country for the news
+        'country': country,
         'apiKey': NEWS_API,
         'pageSize': 3  # The number of results displayed
     }
-    response = requests.get(url, params=params)
-    data = response.json()
+
+    try:
+        # Headlines are shared by everyone asking for the same country
+        data = await api_cache.get(
+            ('news', country),
+            lambda: fetchJson(NEWS_API_URL, params),
+            NEWS_CACHE_TTL
+        )
+    except FETCH_ERRORS as e:
+        await ctx.reply(f'Error: {str(e) or "the news API timed out"}')
+        return
 
     articles = data['articles']
     for article in articles:
@@ -335,178 +1739,437 @@ async def news(ctx):
 
 # XP - Displays the user's XP and level (cmd_xp)
 @bot.command()
-async def xp(ctx, username=None):
+@commands.guild_only()
+async def xp(ctx, member: discord.Member = None):
     # Get user's own XP and level
-    if username is None:
-        user = await prisma.user.find_first(
-            where={'username': ctx.message.author.name},  # Find user in database
-        )
-
-        # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'{ctx.message.author.name}\'s XP',
-                              description=f'XP: {user.xp} | Level: {user.level}',
-                              color=0x02F0FF)
+    if member is None:
+        member = ctx.message.author
 
-    # Get another user's XP and level
-    else:
-        user = await prisma.user.find_first(
-            where={'username': username},  # Find user in database
-        )
+    user = await getUser(userKey(member))  # Find user in cache or database
 
-        # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'{username}\'s XP',
-                              description=f'XP: {user.xp} | Level: {user.level}',
-                              color=0x02F0FF)
+    # Generate an embed to send in the channel (members without a row haven't earned anything yet)
+    embed = discord.Embed(title=f'{member.name}\'s XP',
+                          description=f'XP: {user.xp if user else 0} | Level: {user.level if user else 0}',
+                          color=0x02F0FF)
 
     # Send the embed to the Discord channel
     await ctx.reply(embed=embed)
 
 
-# Award XP - Awards XP to a user (cmd_xp_award)
-async def awardXp(username, xp, channel_id):
-    # Give user XP
-    await prisma.user.update(
-        where={'username': username},  # Find user in database
-        data={'xp': {'increment': xp}}  # Add XP
+# Award XP - Awards XP to a user (cmd_xp_award), returns (old level, new level) or None for unknown users
+async def awardXp(member, xp, channel_id):
+    await ensureUser(member)
+    rows = await awardXpBatch({userKey(member): xp})  # Increment, level up & read back in one round trip
+    if not rows:
+        return None
+
+    row = rows[0]
+    cacheUser(row)
+
+    # Check if the user has leveled up
+    if row['level'] > row['old_level']:
+        await announceLevelUp(member.name, row['level'], channel_id)
+
+    return row['old_level'], row['level']
+
+
+# Total XP needed to reach a level (150 for level 1, 500 for level 2, ...)
+# Same curve as the old per-call formula, which levelled up from n - 1 once XP reached n * 100 * (n + 0.5)
+def levelThreshold(level):
+    return 100 * level * level + 50 * level
+
+
+# Level curve, computed once: LEVEL_THRESHOLDS[n] is the total XP needed for level n
+LEVEL_THRESHOLDS = [levelThreshold(level) for level in range(MAX_LEVEL + 1)]
+LEVEL_THRESHOLDS_SQL = f"ARRAY[{', '.join(str(xp) for xp in LEVEL_THRESHOLDS[1:])}]::bigint[]"
+
+
+# Level for a total amount of XP (any number of levels at once)
+def levelForXp(xp):
+    return bisect_right(LEVEL_THRESHOLDS, xp) - 1 if xp >= 0 else 0
+
+
+# SQL for the level of xp_sql on the curve
+# width_bucket binary searches the thresholds, the same lookup as levelForXp
+def curveLevelSql(xp_sql):
+    return f'width_bucket(({xp_sql})::bigint, {LEVEL_THRESHOLDS_SQL})'
+
+
+# SQL for a user's level after their XP changes to xp_sql (levels never go down)
+def levelSql(xp_sql):
+    return f'GREATEST(u.level, {curveLevelSql(xp_sql)})'
+
+
+# Award XP to many users with a single UPDATE ... RETURNING (callers keep it to COUNTER_FLUSH_CHUNK users)
+# The new level is calculated by the database from the locked row, so concurrent awards can't race
+async def awardXpBatch(awards):
+    values = []
+    params = []
+    for (guild_id, user_id), xp in awards.items():
+        values.append(f'(${len(params) + 1}::bigint, ${len(params) + 2}::bigint, ${len(params) + 3}::int)')
+        params += [guild_id, user_id, xp]
+
+    return await prisma.query_raw(
+        f'''
+        WITH award (guild_id, user_id, xp) AS (VALUES {', '.join(values)}),
+        old AS (
+            SELECT u.guild_id, u.user_id, u.level FROM "User" u
+            JOIN award a ON a.guild_id = u.guild_id AND a.user_id = u.user_id
+            FOR UPDATE OF u
+        )
+        UPDATE "User" u
+        SET xp = u.xp + a.xp,
+            level = {levelSql('u.xp + a.xp')}
+        FROM award a, old o
+        WHERE u.guild_id = a.guild_id AND u.user_id = a.user_id
+          AND o.guild_id = u.guild_id AND o.user_id = u.user_id
+        RETURNING u.guild_id, u.user_id, u.username, o.level AS old_level, u.level AS level, u.xp AS xp, u.coins, u.level_rank
+        ''',
+        *params
     )
 
-    # Get user's current level
-    user = await prisma.user.find_first(
-        where={'username': username},  # Find user in database
+
+# Announce a level up in the channel the XP was earned in
+async def announceLevelUp(username, level, channel_id):
+    # Success message (terminal only)
+    print(f'Prisma: {username} has leveled up to level {level}!')
+
+    # Generate an embed to send in the channel
+    embed = discord.Embed(
+        title="Level Up!",
+        description=f"{username} has leveled up to level {level}!",
+        color=discord.Color.green()
     )
 
-    # Calculate the level based on the XP
-    # level = int(user.xp ** (1 / 5))
+    # Send the embed in the original channel (skipped if it was deleted or isn't cached, e.g. an archived thread)
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        return
+    await channel.send(embed=embed)
 
-    # Calculate level as XP / 150
-    level = int(user.xp / (100 * (user.level + 1 * 1.5)))
 
-    # Check if the user has leveled up
-    if level > user.level:
-        # Update the user's level
-        await prisma.user.update(
-            where={'username': username},  # Find user in database
-            data={'level': level}  # Set level to new level
+# Set every level in this process's shards from the level curve (after changing it), a chunk of users at a time
+# Users are streamed in key order & each chunk's changed levels are written with one UPDATE ... FROM (VALUES ...)
+# Covers one guild when `guild_id` is given (cmd_recompute_levels), otherwise every guild in this process's shards
+async def recomputeAllLevels(guild_id=None):
+    if guild_id is None:
+        scope, scope_params = shardFilterSql('guild_id'), []
+    else:
+        scope, scope_params = 'guild_id = $3', [guild_id]
+
+    await flushCounters()  # Write buffered XP first
+
+    cursor = (0, 0)
+    checked = 0
+    changed = 0
+    while True:
+        users = await prisma.query_raw(
+            f'''
+            SELECT guild_id, user_id, xp, level FROM "User"
+            WHERE (guild_id, user_id) > ($1::bigint, $2::bigint) AND {scope}
+            ORDER BY guild_id, user_id
+            LIMIT {LEVEL_RECOMPUTE_CHUNK}
+            ''',
+            *cursor, *scope_params
         )
-        # Success message (terminal only)
-        print(f'Prisma: {username} has leveled up to level {level}!')
 
-        # Generate an embed to send in the channel
-        embed = discord.Embed(
-            title="Level Up!",
-            description=f"{username} has leveled up to level {level}!",
-            color=discord.Color.green()
-        )
+        levels = [levelForXp(user['xp']) for user in users]  # The whole chunk at once
+        stale = [rowKey(user) for user, level in zip(users, levels) if level != user['level']]
+        updated = []
+        if stale:
+            values = []
+            params = []
+            for key in stale:
+                values.append(f'(${len(params) + 1}::bigint, ${len(params) + 2}::bigint)')
+                params += key
+
+            # The level is taken from the XP the row has when it's written, not the XP we read
+            # (awards keep levels from going down, so a user who earned XP since the read still needs the curve)
+            updated = await prisma.query_raw(
+                f'''
+                UPDATE "User" u SET level = {curveLevelSql('u.xp')}
+                FROM (VALUES {', '.join(values)}) AS v (guild_id, user_id)
+                WHERE u.guild_id = v.guild_id AND u.user_id = v.user_id AND u.level <> {curveLevelSql('u.xp')}
+                RETURNING u.guild_id, u.user_id, u.level
+                ''',
+                *params
+            )
+
+            for row in updated:
+                key = rowKey(row)
+                user_cache.update(key, level=row['level'])
+                index = rankIndex(key[0])
+                ranked = index.users.get(key[1])
+                if ranked is not None:
+                    index.set(key[1], ranked[0], row['level'], ranked[2])
+
+        checked += len(users)
+        changed += len(updated)
+        if len(users) < LEVEL_RECOMPUTE_CHUNK:
+            break
+        cursor = rowKey(users[-1])
 
-        # Send the embed in the original channel
-        await bot.get_channel(channel_id).send(embed=embed)
+    print(f'Prisma: Recomputed levels for {checked} users, {changed} changed')
+    return checked, changed
+
+
+# Recompute Levels - Sets this guild's levels from the level curve (cmd_recompute_levels)
+@bot.command()
+@commands.guild_only()
+@commands.has_any_role("Moderator", "Administrator", "Owner")
+async def recomputeLevels(ctx):
+    checked, changed = await recomputeAllLevels(ctx.guild.id)  # Only this guild's members
+    await ctx.reply(f'Recomputed levels for {checked} users, {changed} changed')
 
 
 # Manually give a user xp (cmd_xp_give)
 @bot.command()
-async def xp_give(ctx, username, xp):
+@commands.guild_only()
+async def xp_give(ctx, member: discord.Member, xp):
     # Give user XP
-    await awardXp(username, int(xp), ctx.message.channel.id)
+    await awardXp(member, int(xp), ctx.message.channel.id)
 
     # delete user's message
     await ctx.message.delete()
 
 
-# Give coins - Awards coins to a user (cmd_coins_award)
-async def addCoins(username, coins, channel_id):
-    # Give user coins
-    await prisma.user.update(
-        where={'username': username},  # Find user in database
-        data={'coins': {'increment': coins}}  # Add coins
+# Change a balance & append the change to the coin ledger in one statement, so they can't diverge
+# Returns the updated user, or None for unknown users
+async def changeCoins(member, amount, reason):
+    await ensureUser(member)
+    guild_id, user_id = userKey(member)
+    rows = await prisma.query_raw(
+        '''
+        WITH changed AS (
+            UPDATE "User" SET coins = coins + $3
+            WHERE guild_id = $1 AND user_id = $2
+            RETURNING guild_id, user_id, username, xp, level, coins, level_rank
+        ), ledger AS (
+            INSERT INTO "CoinTransaction" (guild_id, user_id, amount, reason, created_at)
+            SELECT guild_id, user_id, $3, $4, NOW() FROM changed
+        )
+        SELECT * FROM changed
+        ''',
+        guild_id, user_id, amount, reason
     )
+    return cacheUser(rows[0]) if rows else None  # Write through to the cache
+
+
+# Give coins - Awards coins to a user (cmd_coins_award)
+async def addCoins(member, coins, channel_id, reason='addCoins'):
+    await changeCoins(member, coins, reason)
 
 
 # Take coins - Awards coins to a user (cmd_coins_award)
-async def takeCoins(username, coins, channel_id):
-    # Give user coins
-    await prisma.user.update(
-        where={'username': username},  # Find user in database
-        data={'coins': {'decrement': int(coins)}}  # Add coins
+async def takeCoins(member, coins, channel_id, reason='takeCoins'):
+    await changeCoins(member, -int(coins), reason)
+
+
+# Settle a bet in one statement: check balance >= bet, apply the outcome, award XP & append to the coin ledger
+# Returns the updated user row, or None if the user doesn't have enough coins (nothing is changed)
+async def settleBet(member, bet, winnings, xp, channel_id, reason):
+    await ensureUser(member)
+    guild_id, user_id = userKey(member)
+    rows = await prisma.query_raw(
+        f'''
+        WITH old AS (
+            SELECT level FROM "User" WHERE guild_id = $1 AND user_id = $2 FOR UPDATE
+        ), settled AS (
+            UPDATE "User" u
+            SET coins = u.coins + $4,
+                xp = u.xp + $5,
+                level = {levelSql('u.xp + $5')}
+            FROM old o
+            WHERE u.guild_id = $1 AND u.user_id = $2 AND u.coins >= $3
+            RETURNING u.guild_id, u.user_id, u.username, o.level AS old_level, u.level AS level, u.xp AS xp, u.coins, u.level_rank
+        ), ledger AS (
+            INSERT INTO "CoinTransaction" (guild_id, user_id, amount, reason, created_at)
+            SELECT guild_id, user_id, $4, $6, NOW() FROM settled
+        )
+        SELECT * FROM settled
+        ''',
+        guild_id, user_id, bet, winnings, xp, reason
     )
+    if not rows:
+        return None
+
+    row = rows[0]
+    user = cacheUser(row)  # Write through to the cache
+    if row['level'] > row['old_level']:
+        await announceLevelUp(member.name, row['level'], channel_id)
+    return user
+
+
+# Reply that a bet was refused for a lack of coins
+async def replyNotEnoughCoins(ctx, title):
+    user = await getUser(userKey(ctx.message.author))  # Usually cached
+    embed = discord.Embed(title=title,
+                          description=f'You only have {user.coins if user else 0} coins!',
+                          color=0x02F0FF)
+    await ctx.reply(embed=embed)
 
 
 # Determine user's rank (cmd_rank)
 @bot.command()
-async def rank(ctx, username=None):
-    # Get user's own XP and level
-    if username is None:
-        user = await prisma.user.find_first(
-            where={'username': ctx.message.author.name},  # Find user in database
-        )
+@commands.guild_only()
+async def rank(ctx, member: discord.Member = None):
+    # Get user's own rank
+    if member is None:
+        member = ctx.message.author
 
-        # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'{ctx.message.author.name}\'s Rank',
-                              description=f'Rank: {user.rank}',
-                              color=0x02F0FF)
-
-    # Get another user's XP and level
-    else:
-        user = await prisma.user.find_first(
-            where={'username': username},  # Find user in database
-        )
+    index = rankIndex(ctx.guild.id)
+    position = index.rank(member.id)  # O(log n) lookup in the guild's rank index
 
-        # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'{username}\'s Rank',
-                              description=f'Rank: {user.rank}',
-                              color=0x02F0FF)
+    # Generate an embed to send in the channel
+    embed = discord.Embed(title=f'{member.name}\'s Rank',
+                          description=f'Rank: {position} of {len(index)}' if position else 'Rank: unranked',
+                          color=0x02F0FF)
 
     # Send the embed to the Discord channel
     await ctx.reply(embed=embed)
 
 
-# Leaderboard - Displays the top 10 users by xp earned (cmd_leaderboard)
-@bot.command()
-async def leaderboard(ctx):
-    # Get the top 10 users by xp
-    users = await prisma.user.find_many(
-        skip=0,  # Skip the first 0 users
-        take=10,  # Take the top 10 users
-        order={'xp': 'desc'}  # Order the users by xp in descending order
+# Fetch a guild's leaderboard page with keyset pagination on (xp desc, user_id asc)
+# Starting after/before a (xp, user_id) key costs the same index seek at any depth, unlike skip
+async def fetchLeaderboardPage(guild_id, after=None, before=None):
+    if before is not None:
+        xp_value, user_id = before
+        users = await prisma.user.find_many(
+            where={
+                'guild_id': guild_id,
+                'OR': [{'xp': {'gt': xp_value}}, {'xp': xp_value, 'user_id': {'lt': user_id}}]
+            },
+            take=LEADERBOARD_PAGE_SIZE,
+            order=[{'xp': 'asc'}, {'user_id': 'desc'}]  # Walk backwards from the key
+        )
+        return list(reversed(users))
+
+    where = {'guild_id': guild_id}
+    if after is not None:
+        xp_value, user_id = after
+        where['OR'] = [{'xp': {'lt': xp_value}}, {'xp': xp_value, 'user_id': {'gt': user_id}}]
+    return await prisma.user.find_many(
+        where=where,
+        take=LEADERBOARD_PAGE_SIZE,
+        order=[{'xp': 'desc'}, {'user_id': 'asc'}]  # Order the users by xp in descending order
     )
 
-    # Generate an embed to send in the channel
-    embed = discord.Embed(title='Server Leaderboard', color=0x02F0FF)
 
-    count = 1
+# Fetch the leaderboard page starting at a 1-based position, using the rank index to find the key to start after
+# The index holds the XP in the database (not buffered XP), so its order is the order of the pages
+async def fetchLeaderboardAt(guild_id, position):
+    if position <= 1:
+        return await fetchLeaderboardPage(guild_id)
+    xp_key, user_id = rankIndex(guild_id).order[position - 2]
+    return await fetchLeaderboardPage(guild_id, after=(-xp_key, user_id))
+
+
+# Generate the leaderboard embed for a page of users
+def leaderboardEmbed(users, start, total, highlight=None):
+    embed = discord.Embed(title='Server Leaderboard', color=0x02F0FF)
 
     # Add each user to the embed
-    for user in users:
-        embed.add_field(name=f'{count}. {user.username}', value=f'XP: {user.xp} | Level: {user.level}', inline=False)
-        count += 1
+    for count, user in enumerate(users, start=start):
+        name = f'**{user.username}**' if user.user_id == highlight else user.username
+        embed.add_field(name=f'{count}. {name}', value=f'XP: {user.xp} | Level: {user.level}', inline=False)
+
+    embed.set_footer(text=f'Positions {start}-{start + len(users) - 1} of {total}')
+    return embed
+
+
+# Previous/Next buttons for paging through the leaderboard
+class LeaderboardView(discord.ui.View):
+    def __init__(self, guild_id, users, start, highlight=None):
+        super().__init__(timeout=LEADERBOARD_TIMEOUT)
+        self.guild_id = guild_id
+        self.users = users  # Users on the current page
+        self.start = start  # Position of the first user on the page
+        self.highlight = highlight  # User ID to show in bold
+        self.updateButtons()
+
+    def updateButtons(self):
+        self.previous.disabled = self.start <= 1
+        self.next.disabled = len(self.users) < LEADERBOARD_PAGE_SIZE
+
+    async def showPage(self, interaction, users, start):
+        if not users:
+            await interaction.response.defer()
+            return
+        self.users, self.start = users, start
+        self.updateButtons()
+        embed = leaderboardEmbed(users, start, len(rankIndex(self.guild_id)), self.highlight)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        first = self.users[0]
+        users = await fetchLeaderboardPage(self.guild_id, before=(first.xp, first.user_id))
+        await self.showPage(interaction, users, max(1, self.start - len(users)))
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        last = self.users[-1]
+        users = await fetchLeaderboardPage(self.guild_id, after=(last.xp, last.user_id))
+        await self.showPage(interaction, users, self.start + len(self.users))
+
+
+# Leaderboard - Displays the users by xp earned, a page at a time (cmd_leaderboard)
+# ?leaderboard | ?leaderboard page [number] | ?leaderboard me | ?leaderboard around [member]
+@bot.command()
+@commands.guild_only()
+async def leaderboard(ctx, view='page', value=None):
+    index = rankIndex(ctx.guild.id)
+    highlight = None
+    if view.isdigit():
+        view, value = 'page', view  # ?leaderboard 3
+
+    # Page N starts at position (N - 1) * page size + 1
+    if view == 'page':
+        page = int(value) if value is not None else 1
+        start = (max(page, 1) - 1) * LEADERBOARD_PAGE_SIZE + 1
+
+    # Centre the page around a user's own position
+    elif view in ('me', 'around'):
+        member = ctx.message.author
+        if value is not None:
+            member = await commands.MemberConverter().convert(ctx, value)
+        highlight = member.id
+        position = index.rank(member.id)
+        if position is None:
+            await ctx.reply(f'{member.name} is not on the leaderboard')
+            return
+        start = max(1, position - LEADERBOARD_PAGE_SIZE // 2)
+
+    else:
+        await ctx.reply('Usage: ?leaderboard [page number] | ?leaderboard me | ?leaderboard around [member]')
+        return
+
+    if start > len(index):
+        await ctx.reply(f'There are only {ceil(len(index) / LEADERBOARD_PAGE_SIZE)} pages')
+        return
+
+    users = await fetchLeaderboardAt(ctx.guild.id, start)
 
     # Send the embed to the Discord channel
-    await ctx.reply(embed=embed)
+    await ctx.reply(embed=leaderboardEmbed(users, start, len(index), highlight),
+                    view=LeaderboardView(ctx.guild.id, users, start, highlight))
 
 
 @bot.command()
+@commands.guild_only()
 async def topThree(ctx):
-    # Get the top 3 users by XP
-    users = await prisma.user.find_many(
-        skip=0,  # Skip the first 0 users
-        take=3,  # Take the top 3 users
-        order={'xp': 'desc'}  # Order the users by XP in descending order
-    )
+    # Get the top 3 users by XP from the rank index
+    users = rankIndex(ctx.guild.id).top(3)
 
-    usernames = [user.username for user in users]
-    xp_values = [user.xp for user in users]
+    usernames = [username for username, _, _ in users]
+    xp_values = [user_xp for _, user_xp, _ in users]
 
     # Code to make the graph
-    plt.bar(usernames, xp_values, color="blue")
-    plt.xlabel('Players')
-    plt.ylabel('XP')
-    plt.title('Top Three Players by XP')
-    plt.savefig('top_three.png')
-    plt.close()
+    file = await renderChart('top_three.png', renderBarChart, usernames, xp_values,
+                             'Players', 'XP', 'Top Three Players by XP')
 
     # Send the image to the Discord channel
-    with open('top_three.png', 'rb') as f:
-        file = discord.File(f)
-        await ctx.send(file=file)
+    await ctx.send(file=file)
 
 
 """
@@ -515,6 +2178,7 @@ async def topThree(ctx):
 
 
 @bot.command()
+@commands.guild_only()
 async def rps(ctx, user_move):
     # create a list of moves
     moves = ['rock', 'paper', 'scissors']
@@ -532,32 +2196,21 @@ async def rps(ctx, user_move):
         await ctx.send(f"I choose {bot_move}, It's a tie!")
     elif (user_move == 'rock' and bot_move == 'scissors'):
         await ctx.send(f"I choose {bot_move}, You win 5 coins!")
-        await addCoins(ctx.message.author.name, 5, ctx.message.channel.id)
+        await addCoins(ctx.message.author, 5, ctx.message.channel.id)
     elif (user_move == 'paper' and bot_move == 'rock'):
         await ctx.send(f"I choose {bot_move}, You win 5 coins!")
-        await addCoins(ctx.message.author.name, 5, ctx.message.channel.id)
+        await addCoins(ctx.message.author, 5, ctx.message.channel.id)
     elif (user_move == 'scissors' and bot_move == 'paper'):
         await ctx.send(f"I choose {bot_move}, You win 5 coins!")
-        await addCoins(ctx.message.author.name, 5, ctx.message.channel.id)
+        await addCoins(ctx.message.author, 5, ctx.message.channel.id)
     else:
         await ctx.send(f"I choose {bot_move}, I win!")
 
 
-# Check if the user has enough coins to bet
-async def checkCoins(username):
-    # Get user's coins
-    user = await prisma.user.find_first(
-        where={'username': username},  # Find user in database
-    )
-
-    return user.coins
-
-
 # Roll - Rolls a die and returns a random number (cmd_roll), user can also bet coins on a number and win/lose coins
 @bot.command()
+@commands.guild_only()
 async def roll(ctx, bet=None, number=None):
-    balance = await checkCoins(ctx.message.author.name)
-
     # Check if the user has bet any coins
     if bet is None:
         # Generate a random number between 1 and 6
@@ -569,7 +2222,7 @@ async def roll(ctx, bet=None, number=None):
                               color=0x02F0FF)
 
         # Award 5 xp
-        await awardXp(ctx.message.author.name, 5, ctx.message.channel.id)
+        await awardXp(ctx.message.author, 5, ctx.message.channel.id)
 
         # Send the embed to the Discord channel
         await ctx.reply(embed=embed)
@@ -606,55 +2259,50 @@ async def roll(ctx, bet=None, number=None):
             # Send the embed to the Discord channel
             await ctx.reply(embed=embed)
 
-        # Check if the user has enough coins to bet
-        elif balance < int(bet):
-            # Generate an embed to send in the channel
-            embed = discord.Embed(title='Roll',
-                                  description=f'Not enough coins!',
-                                  color=0x02F0FF)
-
-            # Send the embed to the Discord channel
-            await ctx.reply(embed=embed)
-
         else:
+            bet = int(bet)
+
             # Generate a random number between 1 and 6
             roll = random.randint(1, 6)
+            won = int(number) == roll
 
-            # Check if the user won the bet
-            if int(number) == roll:
+            # Win 6x the bet & 10 xp, or lose the bet & get 5 xp, only if the user has enough coins
+            user = await settleBet(ctx.message.author, bet, bet * 6 if won else -bet, 10 if won else 5,
+                                   ctx.message.channel.id, 'roll')
+
+            # Check if the user has enough coins to bet
+            if user is None:
                 # Generate an embed to send in the channel
                 embed = discord.Embed(title='Roll',
-                                      description=f'You rolled a {roll} and won {int(bet) * 6} coins! You now have {balance + int(bet) * 6} coins!',
+                                      description=f'Not enough coins!',
                                       color=0x02F0FF)
 
-                # Award 10 xp
-                await awardXp(ctx.message.author.name, 10, ctx.message.channel.id)
+                # Send the embed to the Discord channel
+                await ctx.reply(embed=embed)
 
-                # Add coins to user's balance
-                await addCoins(ctx.message.author.name, int(bet) * 6, ctx.message.channel.id)
+            # Check if the user won the bet
+            elif won:
+                # Generate an embed to send in the channel
+                embed = discord.Embed(title='Roll',
+                                      description=f'You rolled a {roll} and won {bet * 6} coins! You now have {user.coins} coins!',
+                                      color=0x02F0FF)
 
                 # Send the embed to the Discord channel
                 await ctx.reply(embed=embed)
 
-                print(f'{ctx.message.author.name} won {int(bet) * 6} coins!')
+                print(f'{ctx.message.author.name} won {bet * 6} coins!')
 
             # Check if the user lost the bet
             else:
                 # Generate an embed to send in the channel
                 embed = discord.Embed(title='Roll',
-                                      description=f'You rolled a {roll} and lost {bet} coins! You now have {balance - int(bet)} coins!',
+                                      description=f'You rolled a {roll} and lost {bet} coins! You now have {user.coins} coins!',
                                       color=0x02F0FF)
 
-                # Award 5 xp
-                await awardXp(ctx.message.author.name, 5, ctx.message.channel.id)
-
-                # Remove coins from user's balance
-                await takeCoins(ctx.message.author.name, int(bet), ctx.message.channel.id)
-
                 # Send the embed to the Discord channel
                 await ctx.reply(embed=embed)
 
-                print(f'{ctx.message.author.name} lost {int(bet)} coins!')
+                print(f'{ctx.message.author.name} lost {bet} coins!')
 
 
 # 8 Ball - Answers a question (cmd_8ball)
@@ -692,15 +2340,15 @@ async def _8ball(ctx, *, question):
 
 # Roulette with coin betting system (cmd_roulette)
 @bot.command()
+@commands.guild_only()
 async def roulette(ctx, bet):
-    # Get user's own coins
-    balance = await checkCoins(ctx.message.author.name)
+    bet = int(bet)
 
-    # Check if user has enough coins
-    if balance < int(bet):
+    # make sure bet is more than 0
+    if bet <= 0:
         # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'Insufficient Coins',
-                              description=f'You only have {balance} coins!',
+        embed = discord.Embed(title=f'Invalid Bet',
+                              description=f'Your bet must be at least 1 coin!',
                               color=0x02F0FF)
 
         # Send the embed to the Discord channel
@@ -713,45 +2361,41 @@ async def roulette(ctx, bet):
     # Generate winning number
     winning_number = random.randint(0, 6)
 
-    print(f'Roulette: {ctx.message.author.name} rolled {number} and the winning number is {winning_number}')
+    # Win 3x the bet or lose the bet, with 15 xp either way, only if the user has enough coins
+    winnings = ceil(bet * 3) if number == winning_number else -bet
+    user = await settleBet(ctx.message.author, bet, winnings, 15, ctx.message.channel.id, 'roulette')
 
-    await awardXp(ctx.message.author.name, 15, ctx.message.channel.id)  # Award XP
+    # Check if user had enough coins
+    if user is None:
+        await replyNotEnoughCoins(ctx, 'Insufficient Coins')
+        return
+
+    print(f'Roulette: {ctx.message.author.name} rolled {number} and the winning number is {winning_number}')
 
     # Check if user won
     if number != winning_number:
         # Generate an embed to send in the channel
         embed = discord.Embed(title=f'Roulette',
-                              description=f'You lost {bet} coins. Your balance is now: {balance - int(bet)} coins.',
+                              description=f'You lost {bet} coins. Your balance is now: {user.coins} coins.',
                               color=0x02F0FF)
-
-        # Send the embed to the Discord channel
-        await ctx.reply(embed=embed)
-
-        # Take user's coins
-        await takeCoins(ctx.message.author.name, bet, ctx.message.channel.id)
     else:
-        # multiply bet
-        bet = ceil(int(bet) * 3)
-
         # Generate an embed to send in the channel
         embed = discord.Embed(title=f'Roulette',
-                              description=f'You **won** {bet} coins! Your balance is now: {balance + int(bet)} coins.',
+                              description=f'You **won** {winnings} coins! Your balance is now: {user.coins} coins.',
                               color=0x02F0FF)
 
-        # Send the embed to the Discord channel
-        await ctx.reply(embed=embed)
-
-        # Give user coins
-        await addCoins(ctx.message.author.name, bet, ctx.message.channel.id)
+    # Send the embed to the Discord channel
+    await ctx.reply(embed=embed)
 
 
 # Coinflip with coin betting system (cmd_coinflip)
 @bot.command(aliases=['flip'])
+@commands.guild_only()
 async def coinflip(ctx, bet):
-    balance = await checkCoins(ctx.message.author.name)
+    bet = int(bet)
 
     # make sure bet is more than 0
-    if int(bet) <= 0:
+    if bet <= 0:
         # Generate an embed to send in the channel
         embed = discord.Embed(title=f'Invalid Bet',
                               description=f'Your bet must be at least 1 coin!',
@@ -761,51 +2405,37 @@ async def coinflip(ctx, bet):
         await ctx.reply(embed=embed)
         return
 
-    # Check if user has enough coins
-    if balance < int(bet):
-        # Generate an embed to send in the channel
-        embed = discord.Embed(title=f'Insufficient Coins',
-                              description=f'You only have {balance} coins!',
-                              color=0x02F0FF)
-
-        # Send the embed to the Discord channel
-        await ctx.reply(embed=embed)
-        return
-
     # Generate a random number
     number = random.randint(0, 1)
 
     # Generate winning number
     winning_number = random.randint(0, 1)
 
-    print(f'Coinflip: {ctx.message.author.name} flipped {number} and the winning number is {winning_number}')
+    # Win or lose the bet, with 10 xp either way, only if the user has enough coins
+    user = await settleBet(ctx.message.author, bet, bet if number == winning_number else -bet, 10,
+                           ctx.message.channel.id, 'coinflip')
+
+    # Check if user had enough coins
+    if user is None:
+        await replyNotEnoughCoins(ctx, 'Insufficient Coins')
+        return
 
-    # Award some xp
-    await awardXp(ctx.message.author.name, 10, ctx.message.channel.id)
+    print(f'Coinflip: {ctx.message.author.name} flipped {number} and the winning number is {winning_number}')
 
     # Check if user won
     if number != winning_number:
         # Generate an embed to send in the channel
         embed = discord.Embed(title=f'Coinflip',
-                              description=f'You lost {bet} coins. Your balance is now: {balance - int(bet)} coins.',
+                              description=f'You lost {bet} coins. Your balance is now: {user.coins} coins.',
                               color=0x02F0FF)
-
-        # Send the embed to the Discord channel
-        await ctx.reply(embed=embed)
-
-        # Take user's coins
-        await takeCoins(ctx.message.author.name, int(bet), ctx.message.channel.id)
     else:
         # Generate an embed to send in the channel
         embed = discord.Embed(title=f'Coinflip',
-                              description=f'You **won** {bet} coins! Your balance is now: {balance + int(bet)} coins.',
+                              description=f'You **won** {bet} coins! Your balance is now: {user.coins} coins.',
                               color=0x02F0FF)
 
-        # Send the embed to the Discord channel
-        await ctx.reply(embed=embed)
-
-        # Give user coins
-        await addCoins(ctx.message.author.name, int(bet), ctx.message.channel.id)
+    # Send the embed to the Discord channel
+    await ctx.reply(embed=embed)
 
 
 """
@@ -815,14 +2445,13 @@ COINS SYSTEM
 
 # Coins - Displays the user's own coins (cmd_coins)
 @bot.command()
+@commands.guild_only()
 async def coins(ctx):
-    user = await prisma.user.find_first(
-        where={'username': ctx.message.author.name},  # Find user in database
-    )
+    user = await getUser(userKey(ctx.message.author))  # Find user in cache or database
 
     # Generate an embed to send in the channel
     embed = discord.Embed(title=f'{ctx.message.author.name}\'s Coins',
-                          description=f'Coins: {user.coins}',
+                          description=f'Coins: {user.coins if user else 0}',  # No row yet, no coins yet
                           color=0x02F0FF)
 
     # Send the embed to the Discord channel
@@ -830,20 +2459,17 @@ async def coins(ctx):
 
 
 # Award Coins - Awards coins to a user (cmd_coins_award)
-async def awardCoins(username, coins, channel_id):
+async def awardCoins(member, coins, channel_id):
     # Give user coins
-    await prisma.user.update(
-        where={'username': username},  # Find user in database
-        data={'coins': {'increment': coins}}  # Add coins
-    )
+    await changeCoins(member, coins, 'awardCoins')
 
     # Success message (terminal only)
-    print(f'Prisma: {username} has been awarded {coins} coins!')
+    print(f'Prisma: {member.name} has been awarded {coins} coins!')
 
     # Generate an embed to send in the channel
     embed = discord.Embed(
         title="Coins Awarded!",
-        description=f"{username} has been awarded {coins} coins!",
+        description=f"{member.name} has been awarded {coins} coins!",
         color=discord.Color.green()
     )
 
@@ -851,109 +2477,682 @@ async def awardCoins(username, coins, channel_id):
     await bot.get_channel(channel_id).send(embed=embed)
 
 
+"""
+COIN LEDGER
+"""
+
+
+# Reconcile every balance against the ledger & snapshot it, a chunk of users at a time
+# Each user's expected balance is their last snapshot plus the ledger entries after it, summed by the database
+# Balances are compared as of transaction `high`: coin changes made while this runs have higher ids & are taken back out
+# Covers one guild when `guild_id` is given (cmd_reconcile), otherwise every guild in this process's shards
+async def reconcileLedger(guild_id=None):
+    if guild_id is None:
+        scope, scope_params = shardFilterSql('u.guild_id'), []
+    else:
+        scope, scope_params = 'u.guild_id = $4', [guild_id]
+
+    high = (await prisma.query_raw('SELECT COALESCE(MAX(id), 0) AS id FROM "CoinTransaction"'))[0]['id']
+    cursor = (0, 0)
+    checked = 0
+    mismatches = []
+    while True:
+        users = await prisma.query_raw(
+            f'''
+            SELECT u.guild_id, u.user_id, u.username, u.coins, s.balance, (
+                SELECT COALESCE(SUM(t.amount), 0) FROM "CoinTransaction" t
+                WHERE t.guild_id = u.guild_id AND t.user_id = u.user_id
+                  AND t.id > COALESCE(s.last_tx_id, 0) AND t.id <= $3
+            ) AS delta, (
+                SELECT COALESCE(SUM(t.amount), 0) FROM "CoinTransaction" t
+                WHERE t.guild_id = u.guild_id AND t.user_id = u.user_id AND t.id > $3
+            ) AS since_high
+            FROM "User" u
+            LEFT JOIN "CoinSnapshot" s ON s.guild_id = u.guild_id AND s.user_id = u.user_id
+            WHERE (u.guild_id, u.user_id) > ($1::bigint, $2::bigint) AND {scope}
+            ORDER BY u.guild_id, u.user_id
+            LIMIT {LEDGER_CHUNK_SIZE}
+            ''',
+            *cursor, high, *scope_params
+        )
+
+        # Users without a snapshot (balances from before the ledger) start from their balance as of `high`
+        async with prisma.batch_() as batcher:
+            for user in users:
+                guild_id, user_id = rowKey(user)
+                coins = user['coins'] - int(user['since_high'])
+                if user['balance'] is None:
+                    balance = coins
+                else:
+                    balance = user['balance'] + int(user['delta'])
+                    if balance != coins:
+                        mismatches.append((user['username'], coins, balance))
+
+                batcher.coinsnapshot.upsert(
+                    where={'guild_id_user_id': {'guild_id': guild_id, 'user_id': user_id}},
+                    data={
+                        'create': {'guild_id': guild_id, 'user_id': user_id, 'balance': balance, 'last_tx_id': high},
+                        'update': {'balance': balance, 'last_tx_id': high, 'taken_at': datetime.datetime.now(timezone.utc)},
+                    },
+                )
+
+        checked += len(users)
+        if len(users) < LEDGER_CHUNK_SIZE:
+            break
+        cursor = rowKey(users[-1])
+
+    print(f'Ledger: Reconciled {checked} balances up to transaction {high}, {len(mismatches)} mismatches')
+    for username, coins, expected in mismatches:
+        print(f'Ledger: {username} has {coins} coins, the ledger says {expected}')
+    return checked, mismatches
+
+
+async def ledgerSnapshotLoop():
+    while True:
+        await asyncio.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        try:
+            await reconcileLedger()
+        except Exception as e:
+            print(f'Ledger: Reconciliation failed, retrying next interval ({e})')
+
+
+def startLedgerSnapshots():
+    global ledger_task
+    if ledger_task is None:
+        ledger_task = asyncio.create_task(ledgerSnapshotLoop())
+
+
+def stopLedgerSnapshots():
+    global ledger_task
+    if ledger_task is not None:
+        ledger_task.cancel()
+        ledger_task = None
+
+
+# Reconcile - Checks this guild's balances against the coin ledger (cmd_reconcile)
+@bot.command()
+@commands.guild_only()
+@commands.has_any_role("Moderator", "Administrator", "Owner")
+async def reconcile(ctx):
+    checked, mismatches = await reconcileLedger(ctx.guild.id)  # Only this guild's members
+
+    # Generate an embed to send in the channel
+    embed = discord.Embed(title='Coin Ledger',
+                          description=f'Checked {checked} balances, {len(mismatches)} mismatches',
+                          color=0x02F0FF)
+    for username, coins, expected in mismatches[:10]:
+        embed.add_field(name=username, value=f'Balance: {coins} | Ledger: {expected}', inline=False)
+
+    await ctx.reply(embed=embed)
+
+
 """
 STATS AND GRAPHS
 """
 
 
+# Import matplotlib with the headless Agg backend (only the chart commands need it, so it's not imported at startup)
+def loadCharting():
+    global charting
+    if charting is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        charting = SimpleNamespace(Figure=Figure, FigureCanvasAgg=FigureCanvasAgg)
+    return charting
+
+
+# Import matplotlib in the chart pool once the bot is online, so the first chart doesn't pay for it
+def warmCharting():
+    if charting is None:
+        chart_executor.submit(loadCharting)
+
+
+# Render a bar chart to PNG bytes (runs in the chart pool)
+def renderBarChart(labels, values, xlabel, ylabel, title, rotation=0):
+    charting = loadCharting()
+    figure = charting.Figure()
+    charting.FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    axes.bar(labels, values, color="blue")
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    axes.set_title(title)
+    axes.tick_params(axis='x', labelrotation=rotation)
+
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+
+# Render a pie chart to PNG bytes (runs in the chart pool)
+def renderPieChart(labels, values, title):
+    charting = loadCharting()
+    figure = charting.Figure()
+    charting.FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    axes.pie(values, labels=labels, autopct='%1.1f%%', startangle=90)
+    axes.axis('equal')
+    axes.set_title(title)
+
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+# LRU cache of rendered PNGs keyed by a fingerprint of the chart's data, bounded by total size
+class ChartCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # fingerprint -> PNG bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Fingerprint of a chart type & its input series
+    @staticmethod
+    def fingerprint(render, args):
+        return hashlib.sha256(repr((render.__name__, args)).encode()).hexdigest()
+
+    def get(self, key):
+        png = self.entries.get(key)
+        if png is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)  # Mark as recently used
+        self.hits += 1
+        return png
+
+    # Cache a PNG, evicting the least recently used charts until it fits
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+chart_cache = ChartCache(CHART_CACHE_BYTES)
+
+
+# Render a chart in the chart pool (or reuse the cached render of the same data) and wrap it as an attachment
+async def renderChart(filename, render, *args):
+    key = ChartCache.fingerprint(render, args)
+    png = chart_cache.get(key)
+    if png is None:
+        png = await asyncio.get_running_loop().run_in_executor(chart_executor, render, *args)
+        chart_cache.put(key, png)
+    return discord.File(BytesIO(png), filename=filename)
+
+
 # Channel stats - Displays a bar graph of the number of messages per channel (cmd_channel_stats)
 @bot.command(aliases=['channelstats'])
+@commands.guild_only()
 async def channelStats(ctx):
-    # Fetch channel message counts from database
-    prisma_channels = await prisma.channel.find_many()
-    channels = [channel.name for channel in prisma_channels]
-    counts = [channel.messages for channel in prisma_channels]
+    # This guild's channel message counts from the registry (including buffered messages)
+    guild_channels = [channel for channel in channel_registry.values() if channel.guild_id == ctx.guild.id]
+    channels = [channel.name for channel in guild_channels]
+    counts = [channel.messages + pending_messages.get(channel.id, 0) for channel in guild_channels]
 
     # Plot bar chart
-    plt.bar(channels, counts, color="blue")
-    plt.xlabel('Channel')
-    plt.ylabel('Message Count')
-    plt.title('Most Popular Channels')
-    plt.xticks(rotation=45)
+    picture = await renderChart('channel_message_count.png', renderBarChart, channels, counts,
+                                'Channel', 'Message Count', 'Most Popular Channels', 45)
 
-    # Save plot to file and send to Discord
-    plt.savefig('channel_message_count.png', bbox_inches='tight')
-    plt.clf()
-    with open('channel_message_count.png', 'rb') as f:
-        picture = discord.File(f)
-        await ctx.send(file=picture)
+    # Send to Discord
+    await ctx.send(file=picture)
 
 
 # Weather - Displays the current weather in a location (cmd_weather)
 @bot.command()
 async def weather(ctx, *, location: str):
-    weather_api = WEATHER_API
+    params = {
+        'key': WEATHER_API,
+        'q': location,
+        'aqi': 'no'
+    }
+
+    try:
+        # "London", "london " & "LONDON" all share the same cached response
+        data = await api_cache.get(
+            ('weather', ' '.join(location.lower().split())),
+            lambda: fetchJson(WEATHER_API_URL, params),
+            WEATHER_CACHE_TTL
+        )
+    except FETCH_ERRORS as e:  # Unknown locations are API errors too
+        await ctx.reply(f'Error: {str(e) or "the weather API timed out"}')
+        return
+
+    # Where we fill desired info from json into our vairables.
+    location_name = data['location']['name']
+    temperature_F = data['current']['temp_f']
+    condition = data['current']['condition']['text']
+    icon = data['current']['condition']['icon']
+
+    # Set Up the the data pulled from api into an array
+    embed = discord.Embed(title=f'Current Weather in {location_name}', color=0x3498db)
+    embed.add_field(name='Temperature (°F)', value=f'{temperature_F}°F', inline=False)
+    embed.add_field(name='Condition', value=condition, inline=False)
+    embed.set_thumbnail(url=f'https:{icon}')
+    await ctx.reply(embed=embed)
+
+
+"""
+POLLS
+"""
+
+
+# Regional indicator emoji for an option (🇦, 🇧, ...) and back
+def optionEmoji(index):
+    return chr(0x1f1e6 + index)
+
+
+def optionIndex(emoji):
+    return ord(emoji) - 0x1f1e6 if len(emoji) == 1 else -1
+
+
+# Poll with its vote tally kept in memory, votes are written every POLL_FLUSH_INTERVAL
+class LivePoll:
+    def __init__(self, poll_id, message_id, guild_id, channel_id, author_id, prompt, labels, votes, closes_at, voters=None):
+        self.id = poll_id
+        self.message_id = message_id or poll_id  # Reaction polls are keyed by their own message
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.prompt = prompt
+        self.labels = labels
+        self.votes = votes
+        self.closes_at = closes_at  # None = open until closed by hand
+        self.voters = voters  # user id -> option index for button polls, None for reaction polls
+        self.dirty = set()  # Options whose tally changed since the last write
+        self.dirty_voters = set()  # Users whose vote changed since the last write
+        self.stored = True  # False until the poll's row is created
+        self.view = None
+        self.last_edit = 0.0  # time.monotonic() of the last tally edit
+        self.edit_task = None
+        self.close_task = None
+
+
+# Poll embed with a bar for every option
+def pollEmbed(live, closed=False):
+    embed = discord.Embed(title="Question: ", description=live.prompt, color=0x02F0FF)
+    total_votes = sum(live.votes)
+
+    for i, (label, votes) in enumerate(zip(live.labels, live.votes)):
+        share = votes / total_votes if total_votes else 0
+        filled = round(share * 10)
+        embed.add_field(name=f"Option {optionEmoji(i)}: " + label,
+                        value=f"{'█' * filled}{'░' * (10 - filled)} {votes} ({share:.0%})", inline=False)
+
+    if closed:
+        embed.set_footer(text=f"Poll ID: {live.id} | Closed")
+    elif live.closes_at is not None:
+        embed.set_footer(text=f"Poll ID: {live.id} | Closes")
+        embed.timestamp = live.closes_at
+    else:
+        embed.set_footer(text=f"Poll ID: {live.id}")
+    return embed
+
+
+# Load the open polls of this process's shards so reactions are counted without a query
+async def loadPolls():
+    rows = [row for row in await prisma.poll.find_many(where={'closed': False}, include={'options': True})
+            if ownsGuild(row.guild_id)]
+
+    # Who voted for what in the button polls, so a vote can be changed instead of counted twice
+    voters = {row.id: {} for row in rows if row.message_id is not None}
+    if voters:
+        for vote in await prisma.pollvote.find_many(where={'poll_id': {'in': list(voters)}}):
+            voters[vote.poll_id][vote.user_id] = vote.index
+
+    for row in rows:
+        options = sorted(row.options, key=lambda option: option.index)
+        live = LivePoll(row.id, row.message_id, row.guild_id, row.channel_id, row.author_id, row.prompt,
+                        [option.label for option in options], [option.votes for option in options],
+                        row.closes_at, voters.get(row.id))
+        trackPoll(live)
+        if live.voters is not None:
+            bot.add_view(live.view, message_id=live.message_id)  # Buttons keep working after a restart
+    print(f'Prisma: Loaded {len(live_polls)} open polls')
+
+
+# Start counting votes for a poll and schedule it to close
+def trackPoll(live):
+    live_polls[live.id] = live
+    if live.voters is not None:
+        live.view = PollView(live)
+    if live.closes_at is not None:
+        live.close_task = asyncio.create_task(closePollLater(live))
+
+
+# One button per option, the buttons carry the poll ID so they survive restarts
+class PollView(discord.ui.View):
+    def __init__(self, live):
+        super().__init__(timeout=None)
+        self.live = live
+        for i, label in enumerate(live.labels):
+            button = discord.ui.Button(label=label[:80], emoji=optionEmoji(i), style=discord.ButtonStyle.secondary,
+                                       custom_id=f'poll:{live.id}:{i}', row=i // 5)
+            button.callback = self.voteCallback(i)
+            self.add_item(button)
+
+    def voteCallback(self, index):
+        async def callback(interaction):
+            await castVote(self.live, interaction, index)
+        return callback
+
+
+# Record a button vote, clicking your own option again takes the vote back
+async def castVote(live, interaction, index):
+    if live.id not in live_polls:
+        await interaction.response.send_message("This poll is closed", ephemeral=True)
+        return
+
+    user_id = interaction.user.id
+    previous = live.voters.get(user_id)
+    if previous is not None:
+        live.votes[previous] = max(0, live.votes[previous] - 1)
+        live.dirty.add(previous)
+
+    if previous == index:
+        del live.voters[user_id]
+        reply = f"Took back your vote for {live.labels[index]}"
+    else:
+        live.voters[user_id] = index
+        live.votes[index] += 1
+        live.dirty.add(index)
+        reply = f"Voted for {live.labels[index]}"
 
-    url = f'http://api.weatherapi.com/v1/current.json?key={weather_api}&q={location}&aqi=no'
+    live.dirty_voters.add(user_id)
+    scheduleTallyEdit(live)
+    await interaction.response.send_message(reply, ephemeral=True)
 
+
+def scheduleTallyEdit(live):
+    if live.edit_task is None:
+        live.edit_task = asyncio.create_task(editTallyLater(live))
+
+
+# Count a vote (or take one back) when a poll option reaction is added/removed
+def countVote(payload, change):
+    live = live_polls.get(payload.message_id)
+    if live is None or live.voters is not None or payload.user_id == bot.user.id:
+        return
+
+    index = optionIndex(str(payload.emoji))
+    if 0 <= index < len(live.votes):
+        live.votes[index] = max(0, live.votes[index] + change)
+        live.dirty.add(index)
+        scheduleTallyEdit(live)
+
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    countVote(payload, 1)
+
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    countVote(payload, -1)
+
+
+async def editPollMessage(live, closed=False):
+    message = bot.get_partial_messageable(live.channel_id).get_partial_message(live.message_id)
+    if closed and live.view is not None:
+        await message.edit(embed=pollEmbed(live, closed), view=None)  # No more votes
+    else:
+        await message.edit(embed=pollEmbed(live, closed))
+
+
+# Edit the poll's tally at most once per POLL_EDIT_INTERVAL, votes arriving while this waits go in the same edit
+async def editTallyLater(live):
+    await asyncio.sleep(max(0, live.last_edit + POLL_EDIT_INTERVAL - time.monotonic()))
+    live.edit_task = None  # Votes during the edit schedule the next one
+    live.last_edit = time.monotonic()
     try:
-        response = requests.get(url)
-        data = response.json()
-        if 'error' in data:
-            await ctx.reply(f'Error: {data["error"]["message"]}')
+        await editPollMessage(live)
+    except discord.HTTPException as e:
+        print(f'Poll: Failed to update the tally of poll {live.id} ({e})')
+
+
+# Queue the poll's changed tallies & votes on a batch
+def batchPollVotes(batcher, live, dirty, dirty_voters):
+    for index in dirty:
+        batcher.polloption.update(
+            where={'poll_id_index': {'poll_id': live.id, 'index': index}},
+            data={'votes': live.votes[index]}
+        )
+    for user_id in dirty_voters:
+        if user_id in live.voters:
+            batcher.pollvote.upsert(
+                where={'poll_id_user_id': {'poll_id': live.id, 'user_id': user_id}},
+                data={
+                    'create': {'poll_id': live.id, 'user_id': user_id, 'index': live.voters[user_id]},
+                    'update': {'index': live.voters[user_id]},
+                }
+            )
         else:
-            # Where we fill desired info from json into our vairables.
-            location_name = data['location']['name']
-            temperature_F = data['current']['temp_f']
-            condition = data['current']['condition']['text']
-            icon = data['current']['condition']['icon']
-
-            # Set Up the the data pulled from api into an array
-            embed = discord.Embed(title=f'Current Weather in {location_name}', color=0x3498db)
-            embed.add_field(name='Temperature (°F)', value=f'{temperature_F}°F', inline=False)
-            embed.add_field(name='Condition', value=condition, inline=False)
-            embed.set_thumbnail(url=f'https:{icon}')
-            await ctx.reply(embed=embed)
+            batcher.pollvote.delete_many(where={'poll_id': live.id, 'user_id': user_id})
 
-    except requests.exceptions.RequestException as e:
-        await ctx.reply(f'Error: {e}')
+
+# Write the tally of every option (and every vote) that changed since the last write
+async def flushPollVotes():
+    changes = []
+    for live in live_polls.values():
+        if live.stored and (live.dirty or live.dirty_voters):  # Polls still being created are written next time
+            changes.append((live, live.dirty, live.dirty_voters))
+            live.dirty, live.dirty_voters = set(), set()
+    if not changes:
+        return
+
+    try:
+        async with prisma.batch_() as batcher:
+            for live, dirty, dirty_voters in changes:
+                batchPollVotes(batcher, live, dirty, dirty_voters)
+    except Exception:
+        for live, dirty, dirty_voters in changes:
+            live.dirty |= dirty  # Written next interval
+            live.dirty_voters |= dirty_voters
+        raise
+
+
+async def pollFlushLoop():
+    while True:
+        await asyncio.sleep(POLL_FLUSH_INTERVAL)
+        try:
+            await flushPollVotes()
+        except Exception as e:
+            print(f'Prisma: Failed to write poll votes, retrying next interval ({e})')
+
+
+def startPollFlusher():
+    global poll_flush_task
+    if poll_flush_task is None:
+        poll_flush_task = asyncio.create_task(pollFlushLoop())
+
+
+# Stop the flusher, the pending edits & close timers, and write the final tallies
+async def stopPollFlusher():
+    global poll_flush_task
+    if poll_flush_task is None:
+        return
+    poll_flush_task.cancel()
+    poll_flush_task = None
+    for live in live_polls.values():
+        for task in (live.edit_task, live.close_task):
+            if task is not None:
+                task.cancel()
+    try:
+        await flushPollVotes()
+    except Exception as e:
+        print(f'Prisma: Failed to write poll votes on shutdown ({e})')
+
+
+# Stop counting votes, write the final tally and show the poll as closed
+async def closePoll(live):
+    live_polls.pop(live.id, None)
+    if live.edit_task is not None:
+        live.edit_task.cancel()
+        live.edit_task = None
+
+    try:
+        async with prisma.batch_() as batcher:
+            batcher.poll.update(where={'id': live.id}, data={'closed': True})
+            batchPollVotes(batcher, live, live.dirty, live.dirty_voters)
+    except Exception:
+        live_polls[live.id] = live  # Keep counting until it can be closed
+        raise
+    live.dirty, live.dirty_voters = set(), set()
+    if live.view is not None:
+        live.view.stop()
+
+    try:
+        await editPollMessage(live, closed=True)
+    except discord.HTTPException as e:
+        print(f'Poll: Failed to show poll {live.id} as closed ({e})')
+    print(f'Poll: Closed poll {live.id}')
+
+
+# Close the poll when it expires (right away for polls that expired while the bot was offline)
+async def closePollLater(live):
+    await asyncio.sleep(max(0, (live.closes_at - datetime.datetime.now(timezone.utc)).total_seconds()))
+    live.close_task = None
+    while live.id in live_polls:
+        try:
+            await closePoll(live)
+        except Exception as e:
+            print(f'Prisma: Failed to close poll {live.id}, retrying ({e})')
+            await asyncio.sleep(POLL_FLUSH_INTERVAL)
+
+
+# Stop tracking a poll that could not be created
+def discardPoll(live):
+    live_polls.pop(live.id, None)
+    if live.close_task is not None:
+        live.close_task.cancel()
+    if live.view is not None:
+        live.view.stop()
 
 
 # Poll - Creates a poll (cmd_poll)
 @bot.command()
+@commands.guild_only()
 async def poll(ctx, prompt, *options):
-    embed = discord.Embed(title="Question: ", description=prompt, color=0x02F0FF)
+    if not 1 <= len(options) <= 25:
+        await ctx.reply("A poll needs between 1 and 25 options")
+        return
 
-    for i, option in enumerate(options):
-        embed.add_field(name=f"Option {chr(0x1f1e6 + i)}: " + option, value="", inline=False)
+    # The command message's ID is the poll ID, so the poll is sent once, complete with its footer & buttons
+    closes_at = datetime.datetime.now(timezone.utc) + datetime.timedelta(minutes=POLL_DURATION) if POLL_DURATION else None
+    live = LivePoll(ctx.message.id, None, ctx.guild.id, ctx.channel.id, ctx.author.id, prompt, list(options),
+                    [0] * len(options), closes_at, voters={})
+    live.stored = False  # Votes cast before the row exists are written by the next flush
+    trackPoll(live)
+    live.last_edit = time.monotonic()
 
-    poll_message = await ctx.send(embed=embed)
-    for i in range(len(options)):
-        await poll_message.add_reaction(chr(0x1f1e6 + i))
+    try:
+        poll_message = await ctx.send(embed=pollEmbed(live), view=live.view)
+        live.message_id = poll_message.id
+        await prisma.poll.create(
+            data={
+                'id': live.id,
+                'message_id': poll_message.id,
+                'guild_id': ctx.guild.id,
+                'channel_id': ctx.channel.id,
+                'author_id': ctx.author.id,
+                'prompt': prompt,
+                'closes_at': closes_at,
+                'options': {'create': [{'index': i, 'label': option} for i, option in enumerate(options)]},
+            }
+        )
+    except Exception:
+        discardPoll(live)  # Its buttons answer that the poll is closed
+        raise
+    live.stored = True
 
-    embed.set_footer(text=f"Poll ID: {poll_message.id}")
-    await poll_message.edit(embed=embed)
+
+# Poll Close - Stops a poll from taking votes (cmd_poll_close)
+@bot.command()
+@commands.guild_only()
+async def pollClose(ctx, poll_id: int):
+    live = live_polls.get(poll_id)
+    if live is None or live.guild_id != ctx.guild.id:  # Polls can only be closed from their own guild
+        await ctx.reply("That poll isn't open, check the poll ID")
+        return
+
+    is_moderator = any(role.name in ("Moderator", "Administrator", "Owner") for role in ctx.author.roles)
+    if ctx.author.id != live.author_id and not is_moderator:
+        await ctx.reply("Only the poll's author or a moderator can close it")
+        return
+
+    if live.close_task is not None:
+        live.close_task.cancel()
+        live.close_task = None
+    await closePoll(live)
+    await ctx.reply("Poll closed!")
+
+
+# Vote counts of a poll made before polls were stored, read from the message's reactions
+async def fetchLegacyPoll(channel, poll_id):
+    try:
+        poll_message = await channel.fetch_message(poll_id)  # One request instead of scanning the history
+    except (discord.NotFound, discord.Forbidden):
+        return None
+    if not poll_message.embeds or poll_message.embeds[0].footer.text != f"Poll ID: {poll_id}":
+        return None
+
+    # split the option line but using a colon to setparate the field
+    options = [field.name.split(': ', 1)[1] for field in poll_message.embeds[0].fields]
+    vote_counts = [0] * len(options)
+    for reaction in poll_message.reactions:
+        index = optionIndex(str(reaction.emoji))
+        if 0 <= index < len(options):
+            # the bot has to add one reaction to each option so we subtract one to get the total
+            vote_counts[index] = reaction.count - 1
+    return options, vote_counts
 
 
 # Poll Results - Displays the results of a poll (cmd_poll_results)
 @bot.command()
+@commands.guild_only()
 async def pollResults(ctx, poll_id: int):
-    poll_message = None
-
-    # limit for the message to reduce load on the bot and reduce time taken to execute
-    async for message in ctx.channel.history(limit=100):
-        if message.embeds and message.embeds[0].footer.text == f"Poll ID: {poll_id}":
-            poll_message = message
-            break
+    # Votes are counted as they happen, so the results are a single lookup
+    # Only this guild's polls, other guilds' polls are answered like unknown IDs
+    live = live_polls.get(poll_id)
+    if live is not None and live.guild_id != ctx.guild.id:
+        live = None
+    stored = None if live else await prisma.poll.find_first(where={'id': poll_id, 'guild_id': ctx.guild.id},
+                                                            include={'options': True})
+    if live is not None:
+        results = live.labels, live.votes
+    elif stored is not None:
+        stored_options = sorted(stored.options, key=lambda option: option.index)
+        results = [option.label for option in stored_options], [option.votes for option in stored_options]
+    else:
+        results = await fetchLegacyPoll(ctx.channel, poll_id)
 
-    if poll_message:
-        # split the option line but using a colon to setparate the field
-        options = [field.name.split(': ')[1] for field in poll_message.embeds[0].fields]
-        reactions = poll_message.reactions
-        # the bot has to add one reaction to each option so we subtract one to get the total
+    if results:
+        options, vote_counts = results
         # total votes is counted int order to see if there are any votes in the poll
-        total_votes = sum([reaction.count - 1 for reaction in reactions])
-        vote_counts = [reaction.count - 1 for reaction in reactions]
+        total_votes = sum(vote_counts)
 
         # make a graph if there are reactions in the poll
         if total_votes > 0:
-            plt.pie(vote_counts, labels=options, autopct='%1.1f%%', startangle=90)
-            plt.axis('equal')
-            plt.title("Poll Results")
-            plt.savefig('poll_chart.png')
-            plt.clf()
-            
-            poll_chart = discord.File('poll_chart.png')
+            poll_chart = await renderChart('poll_chart.png', renderPieChart, options, vote_counts, "Poll Results")
             await ctx.reply(file=poll_chart)
         else:
             await ctx.reply("There are 0 vots in this poll, tray again after people vote!")
@@ -961,4 +3160,5 @@ async def pollResults(ctx, poll_id: int):
         await ctx.reply("Cant find that poll, check that the poll ID")
 
 
-bot.run(TOKEN)  # Run the bot
+if __name__ == '__main__':
+    bot.run(TOKEN)  # Run the bot (benchmark.py imports this module without running it)
@@ -0,0 +1,25 @@
+import asyncio
+
+import main
+
+'''
+    RECOMPUTE LEVELS - sets every user's level from the level curve, in every guild
+
+    Run after changing the level curve (levelThreshold in main.py):
+        python recompute_levels.py
+
+    Covers the shards in SHARD_IDS, or every guild when SHARD_IDS isn't set.
+    ?recomputeLevels only covers the guild it is used in.
+    Running bots pick up the new levels as their cached users expire (USER_CACHE_TTL).
+'''
+
+
+async def run():
+    await main.connectToDB()
+    try:
+        await main.recomputeAllLevels()
+    finally:
+        await main.prisma.disconnect()
+
+
+asyncio.run(run())
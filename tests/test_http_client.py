@@ -0,0 +1,123 @@
+import time
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import main
+
+'''
+    HTTP CLIENT - fetchJson & the response cache against a local stub server
+'''
+
+
+# Start a stub API answering every request with handler, run test(url) against it with a fresh session
+def runAgainstStub(handler, test, timeout=0.5):
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+
+        main.HTTP_TIMEOUT = timeout
+        main.http_session = None
+        main.openHttpSession()
+        try:
+            return await test(f'http://127.0.0.1:{port}/api')
+        finally:
+            await main.closeHttpSession()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_returns_json_body():
+    async def handler(request):
+        return web.json_response({'articles': [], 'q': request.query['q']})
+
+    data = runAgainstStub(handler, lambda url: main.fetchJson(url, {'q': 'london'}))
+    assert data == {'articles': [], 'q': 'london'}
+
+
+def test_timeout():
+    async def handler(request):
+        await asyncio.sleep(2)
+        return web.json_response({})
+
+    with pytest.raises(asyncio.TimeoutError):
+        runAgainstStub(handler, main.fetchJson, timeout=0.2)
+
+
+def test_5xx_with_html_body():
+    async def handler(request):
+        return web.Response(status=503, text='<html>Service Unavailable</html>', content_type='text/html')
+
+    with pytest.raises(main.ApiError) as error:
+        runAgainstStub(handler, main.fetchJson)
+    assert error.value.status == 503
+
+
+def test_5xx_with_json_error_body():
+    async def handler(request):
+        return web.json_response({'error': {'code': 9999, 'message': 'Internal application error.'}}, status=503)
+
+    with pytest.raises(main.ApiError, match='Internal application error.'):
+        runAgainstStub(handler, main.fetchJson)
+
+
+def test_2xx_with_bad_json():
+    async def handler(request):
+        return web.Response(status=200, text='{"articles": [', content_type='application/json')
+
+    with pytest.raises(main.ApiError):
+        runAgainstStub(handler, main.fetchJson)
+
+
+def test_2xx_with_error_payload():
+    async def handler(request):
+        return web.json_response({'status': 'error', 'code': 'rateLimited', 'message': 'Too many requests'})
+
+    with pytest.raises(main.ApiError, match='Too many requests'):
+        runAgainstStub(handler, main.fetchJson)
+
+
+# A cache holding an expired (but not yet too stale) good response
+def expiredCache():
+    cache = main.ResponseCache(max_size=10, stale_ttl=60, stale_wait=1)
+    cache.entries['key'] = (time.monotonic() - 1, {'good': True})
+    return cache
+
+
+async def unavailableHtml(request):
+    return web.Response(status=503, text='<html>Service Unavailable</html>', content_type='text/html')
+
+
+async def unavailableJson(request):
+    return web.json_response({'error': {'code': 9999, 'message': 'Internal application error.'}}, status=503)
+
+
+@pytest.mark.parametrize('handler', [unavailableHtml, unavailableJson])
+def test_cache_serves_stale_when_upstream_fails(handler):
+    cache = expiredCache()
+
+    async def test(url):
+        return await cache.get('key', lambda: main.fetchJson(url), ttl=300)
+
+    assert runAgainstStub(handler, test) == {'good': True}
+    assert cache.stale == 1
+    assert cache.entries['key'][1] == {'good': True}  # The error didn't replace the good response
+    assert cache.entries['key'][0] < time.monotonic()  # ...or extend it
+
+
+def test_cache_never_stores_failures():
+    cache = main.ResponseCache(max_size=10, stale_ttl=60, stale_wait=1)
+
+    async def test(url):
+        with pytest.raises(main.ApiError):
+            await cache.get('key', lambda: main.fetchJson(url), ttl=300)
+
+    runAgainstStub(unavailableJson, test)
+    assert 'key' not in cache.entries